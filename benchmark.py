@@ -0,0 +1,223 @@
+"""Benchmark de punta a punta del marcaje contra servicios locales (ctrlit, SMTP, LaunchDarkly y feriados).
+
+Corre main.py tal como lo hace el workflow, con N RUTs sintéticos y sin delays, y reporta
+latencia por RUT (p50/p95), tiempo total y RSS máximo del árbol de procesos (incluye Chrome).
+
+Uso:
+    python benchmark.py --ruts 50 --engine http
+    python benchmark.py --ruts 10 --engine selenium --run-engine asyncio --json bench.json
+    python benchmark.py --ruts 30 --sites 3               # RUTs repartidos en varias páginas de marcaje
+    python benchmark.py --ruts 10 --compare-blocking    # Chrome con y sin bloqueo de recursos
+"""
+import argparse
+import glob
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+from time import perf_counter
+from typing import Dict, List
+
+from fakes import FakeDialServer, FakeHolidayAPI, FakeSMTPServer, write_ld_flag_file
+from procstats import percentile, tree_rss_kb
+
+MAIN_PY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+
+
+def synthetic_ruts(count: int) -> List[str]:
+    """RUTs de 8 dígitos con dígito verificador válido"""
+    ruts = []
+    for i in range(count):
+        body = str(10000000 + i * 7919)
+        total = sum(int(d) * f for d, f in zip(reversed(body), [2, 3, 4, 5, 6, 7] * 2))
+        dv = 11 - total % 11
+        ruts.append(body + {10: "k", 11: "0"}.get(dv, str(dv)))
+    return ruts
+
+
+class RSSSampler(threading.Thread):
+    """Muestrea el RSS del árbol de procesos y guarda el máximo"""
+
+    def __init__(self, pid: int, interval: float = 0.05):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.peak_kb = 0
+        self._stop_event = threading.Event()
+
+    def run(self) -> None:
+        while not self._stop_event.wait(self.interval):
+            self.peak_kb = max(self.peak_kb, tree_rss_kb(self.pid))
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        self.join()
+
+
+def run_benchmark(count: int, engine: str, run_engine: str, latency: float = 0.0,
+                  max_browsers: int = 5, fail_rate: float = 0.0, extra_env: Dict[str, str] = None,
+                  sites: int = 1) -> Dict:
+    """Levanta los servicios falsos, corre main.py una vez y devuelve las métricas.
+
+    Con sites > 1 los RUTs se reparten entre varias páginas de marcaje, indicadas en el valor de su flag.
+    """
+    ruts = synthetic_ruts(count)
+    extra_sites = [f"SITE{i}" for i in range(1, sites)]
+    with tempfile.TemporaryDirectory(prefix="marcaje-bench-") as workdir, \
+            FakeDialServer(latency=latency, fail_rate=fail_rate, extra_sites=extra_sites) as dial, \
+            FakeSMTPServer() as smtp, \
+            FakeHolidayAPI() as holidays:
+        flag_file = os.path.join(workdir, "flags.json")
+        site_codes = dial.sites
+        write_ld_flag_file(flag_file, ruts, {rut: site_codes[i % len(site_codes)]
+                                             for i, rut in enumerate(ruts)} if sites > 1 else None)
+        logs_dir = os.path.join(workdir, "logs")
+
+        env = dict(os.environ)
+        env.update({
+            "CLOCK_IN_ACTIVE": "true",
+            "DEBUG_MODE": "false",
+            "DAEMON_MODE": "false",
+            "SHARD_COUNT": "1",
+            "LD_MODE": "file",
+            "LD_FLAG_FILE": flag_file,
+            "DIAL_URL": dial.dial_url,
+            "SUBMIT_ENGINE": engine,
+            "SUBMIT_FALLBACK": "false",
+            "RUN_ENGINE": run_engine,
+            "MAX_BROWSERS": str(max_browsers),
+            "RANDOM_DELAYS": "false",
+            "PACING_KEYSTROKE": "0",
+            "PACING_SUBMIT": "0",
+            "SMTP_SERVER": "127.0.0.1",
+            "SMTP_PORT": str(smtp.port),
+            "SMTP_STARTTLS": "false",
+            "EMAIL_ADDRESS": "bench@example.com",
+            "EMAIL_PASS": "bench",
+            "HOLIDAY_API_URL": holidays.url,
+            "LOGS_DIR": logs_dir,
+            "CACHE_DIR": os.path.join(workdir, "cache"),
+            "GITHUB_RUN_NUMBER": "bench",
+            "PHASE_TIMINGS": "true",
+            "PYTHONUNBUFFERED": "1",
+        })
+        env.update(extra_env or {})
+
+        output_path = os.path.join(workdir, "output.txt")
+        with open(output_path, "w") as output:
+            started = perf_counter()
+            process = subprocess.Popen([sys.executable, MAIN_PY], env=env, cwd=workdir,
+                                       stdout=output, stderr=subprocess.STDOUT)
+            sampler = RSSSampler(process.pid)
+            sampler.start()
+            returncode = process.wait()
+            wall_time = perf_counter() - started
+            sampler.stop()
+
+        if returncode != 0:
+            with open(output_path) as f:
+                tail = f.read()[-2000:]
+            raise RuntimeError(f"main.py terminó con código {returncode}:\n{tail}")
+
+        events = []
+        for path in glob.glob(os.path.join(logs_dir, "phases-*.jsonl")):
+            with open(path) as f:
+                events.extend(json.loads(line) for line in f if line.strip())
+
+    latencies = [e["seconds"] for e in events if e["phase"] == "mark_rut"]
+    phases: Dict[str, List[float]] = {}
+    for event in events:
+        if event["phase"] != "mark_rut":
+            phases.setdefault(event["phase"], []).append(event["seconds"])
+
+    return {
+        "ruts": count,
+        "engine": engine,
+        "run_engine": run_engine,
+        "marks": len(dial.marks),
+        "emails": len(smtp.messages),
+        "smtp_connections": smtp.connections,
+        "injected_failures": dial.failures,
+        "asset_hits": dial.asset_hits,
+        "page_loads": dict(dial.page_loads),
+        "failed": sum(1 for e in events if e["phase"] == "mark_rut" and not e["ok"]),
+        "latency_p50": percentile(latencies, 50),
+        "latency_p95": percentile(latencies, 95),
+        "wall_time": wall_time,
+        "throughput": count / wall_time if wall_time else 0.0,
+        "peak_rss_mb": sampler.peak_kb / 1024,
+        "phases_p50": {phase: percentile(values, 50) for phase, values in sorted(phases.items())},
+    }
+
+
+def print_report(report: Dict) -> None:
+    print("=" * 60)
+    print(f"📊 BENCHMARK: {report['ruts']} RUTs | motor {report['engine']} | {report['run_engine']}")
+    print("=" * 60)
+    print(f"✅ Marcajes registrados: {report['marks']}/{report['ruts']} | con error: {report['failed']}")
+    if report["injected_failures"]:
+        print(f"💥 Fallos inyectados por la página falsa: {report['injected_failures']}")
+    print(f"🌐 Cargas de la página de marcaje: {sum(report['page_loads'].values())} "
+          f"en {len(report['page_loads'])} sitio(s)")
+    print(f"📧 Correos recibidos: {report['emails']} en {report['smtp_connections']} conexión(es) SMTP")
+    print(f"⏱️ Latencia por RUT: p50 {report['latency_p50']:.3f}s | p95 {report['latency_p95']:.3f}s")
+    print(f"⏱️ Tiempo total: {report['wall_time']:.2f}s | {report['throughput']:.1f} RUTs/s")
+    print(f"💾 RSS máximo: {report['peak_rss_mb']:.1f} MB")
+    print("🔍 Fases (p50):")
+    for phase, seconds in report["phases_p50"].items():
+        print(f"  • {phase}: {seconds:.4f}s")
+
+
+def compare_blocking(count: int, run_engine: str, latency: float, max_browsers: int) -> Dict:
+    """Corre el motor Selenium con y sin bloqueo de recursos; el script de "terceros" se sirve como localhost"""
+    reports = {}
+    for blocking in ("true", "false"):
+        reports[blocking] = run_benchmark(count, "selenium", run_engine, latency, max_browsers,
+                                          extra_env={"BLOCK_RESOURCES": blocking, "BLOCKED_DOMAINS": "localhost"})
+        print(f"\n🧱 BLOCK_RESOURCES={blocking}")
+        print_report(reports[blocking])
+
+    on, off = reports["true"], reports["false"]
+    print("=" * 60)
+    print("🧱 BLOQUEO DE RECURSOS: con vs sin")
+    print("=" * 60)
+    print(f"  • Carga de página p50: {on['phases_p50'].get('page_load', 0):.3f}s vs "
+          f"{off['phases_p50'].get('page_load', 0):.3f}s")
+    print(f"  • Latencia por RUT p50: {on['latency_p50']:.3f}s vs {off['latency_p50']:.3f}s")
+    print(f"  • RSS máximo: {on['peak_rss_mb']:.1f} MB vs {off['peak_rss_mb']:.1f} MB")
+    print(f"  • Recursos descargados: {on['asset_hits']} vs {off['asset_hits']}")
+    return {"blocking": on, "no_blocking": off}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark local del marcaje")
+    parser.add_argument("--ruts", type=int, default=20, help="cantidad de RUTs sintéticos")
+    parser.add_argument("--engine", choices=["http", "selenium"], default="http")
+    parser.add_argument("--run-engine", choices=["threads", "asyncio"], default="threads")
+    parser.add_argument("--max-browsers", type=int, default=5)
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="latencia artificial (s) de la página de marcaje falsa")
+    parser.add_argument("--fail-rate", type=float, default=0.0,
+                        help="fracción de requests a la página falsa que responden 503")
+    parser.add_argument("--sites", type=int, default=1,
+                        help="cantidad de páginas de marcaje entre las que se reparten los RUTs")
+    parser.add_argument("--compare-blocking", action="store_true",
+                        help="corre Selenium con y sin bloqueo de recursos y compara")
+    parser.add_argument("--json", help="guarda el reporte en este archivo")
+    args = parser.parse_args()
+
+    if args.compare_blocking:
+        report = compare_blocking(args.ruts, args.run_engine, args.latency, args.max_browsers)
+    else:
+        report = run_benchmark(args.ruts, args.engine, args.run_engine, args.latency, args.max_browsers,
+                               args.fail_rate, sites=args.sites)
+        print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,354 @@
+"""Servidores locales que imitan los servicios externos del marcaje, para probar sin tocar producción.
+
+- FakeDialServer: página de marcaje de ctrlit y su POST de ENVIAR
+- FakeSMTPServer: servidor SMTP que acepta todo y guarda los correos
+- FakeHolidayAPI: endpoint de feriados con la forma de api.boostr.cl
+- write_ld_flag_file: archivo de flags para el data source de archivo de LaunchDarkly
+
+Uso:
+    python fakes.py            # levanta la página de marcaje falsa y muestra el DIAL_URL a usar
+"""
+import json
+import random
+import secrets
+import socketserver
+import threading
+from email import message_from_bytes
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import sleep
+from typing import Dict, List
+from urllib.parse import parse_qs
+
+DIAL_PAGE = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<meta name="csrf-token" content="{token}">
+<title>ctrlit - marcaje</title>
+<style>
+@font-face {{ font-family: Dial; src: url(/static/dial.woff2); }}
+body {{ font-family: Dial, sans-serif; }}
+</style>
+<script async src="{analytics}"></script>
+</head>
+<body>
+<img src="/static/banner.jpg" alt="">
+<div id="start">
+  <button class="action">ENTRADA</button>
+  <button class="action">SALIDA</button>
+</div>
+<div id="pad" style="display:none">
+  <span id="echo"></span>
+  <ul>
+    <li class="digits">1</li><li class="digits">2</li><li class="digits">3</li>
+    <li class="digits">4</li><li class="digits">5</li><li class="digits">6</li>
+    <li class="digits">7</li><li class="digits">8</li><li class="digits">9</li>
+    <li class="digits">K</li><li class="digits">0</li>
+    <li class="pad-action digits">ENVIAR</li>
+  </ul>
+</div>
+<div id="result"></div>
+<script>
+const token = document.querySelector('meta[name="csrf-token"]').content;
+const start = document.getElementById('start');
+const pad = document.getElementById('pad');
+const echo = document.getElementById('echo');
+const result = document.getElementById('result');
+let action = null;
+let rut = '';
+document.querySelectorAll('button.action').forEach(button => button.onclick = () => {{
+  action = button.innerText.trim();
+  rut = '';
+  echo.innerText = '';
+  result.innerText = '';
+  start.style.display = 'none';
+  pad.style.display = 'block';
+}});
+document.querySelectorAll('li.digits').forEach(li => li.onclick = () => {{
+  const text = li.innerText.trim();
+  if (text !== 'ENVIAR') {{
+    rut += text;
+    echo.innerText = rut;
+    return;
+  }}
+  fetch(location.pathname + '/mark', {{
+    method: 'POST',
+    headers: {{'Content-Type': 'application/x-www-form-urlencoded'}},
+    body: new URLSearchParams({{action: action, rut: rut, _token: token}})
+  }}).then(r => r.json()).then(data => {{
+    pad.style.display = 'none';
+    start.style.display = 'block';
+    result.innerText = data.message;
+  }});
+}});
+</script>
+</body>
+</html>
+"""
+
+
+class FakeDialServer:
+    """Réplica local de la página de marcaje de ctrlit y del POST que hace al presionar ENVIAR"""
+
+    def __init__(self, site: str = "K1NBpBqyjf", latency: float = 0.0, port: int = 0,
+                 fail_rate: float = 0.0, asset_latency: float = 0.2, asset_kb: int = 256,
+                 extra_sites: List[str] = ()):
+        self.site = site
+        # Otros códigos de sitio servidos por el mismo servidor, para RUTs con su propia página
+        self.sites = [site, *extra_sites]
+        self.page_loads: Dict[str, int] = {name: 0 for name in self.sites}
+        self.latency = latency
+        # Imagen, fuente y script de "terceros" (servido como localhost) que la página pide al cargar
+        self.asset_latency = asset_latency
+        self.asset_body = secrets.token_bytes(asset_kb * 1024)
+        self.asset_hits = 0
+        # Fracción de requests que responden 503, para ejercitar reintentos y el circuito
+        self.fail_rate = fail_rate
+        self.failures = 0
+        self.token = secrets.token_hex(16)
+        self.marks: List[Dict[str, str]] = []
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), self._handler())
+        self._thread = None
+
+    @property
+    def dial_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/ctrl/dial/web/{self.site}"
+
+    def site_url(self, site: str) -> str:
+        return f"{self.dial_url.rsplit('/', 1)[0]}/{site}"
+
+    @property
+    def analytics_url(self) -> str:
+        return f"http://localhost:{self._server.server_address[1]}/analytics/tag.js"
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def _reply(self, status: int, body: bytes, content_type: str) -> None:
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _json(self, status: int, data: Dict) -> None:
+                self._reply(status, json.dumps(data).encode(), "application/json")
+
+            def _flaky(self) -> bool:
+                if fake.fail_rate and random.random() < fake.fail_rate:
+                    with fake._lock:
+                        fake.failures += 1
+                    self._reply(503, b"service unavailable", "text/plain")
+                    return True
+                return False
+
+            def _asset(self) -> None:
+                with fake._lock:
+                    fake.asset_hits += 1
+                if fake.asset_latency:
+                    sleep(fake.asset_latency)
+                kind = {"jpg": "image/jpeg", "woff2": "font/woff2", "js": "text/javascript"}
+                body = b"" if self.path.endswith(".js") else fake.asset_body
+                self._reply(200, body, kind.get(self.path.rsplit(".", 1)[-1], "application/octet-stream"))
+
+            def do_GET(self):
+                if self.path.startswith(("/static/", "/analytics/")):
+                    self._asset()
+                    return
+                site = self.path.split("?")[0].rsplit("/", 1)[-1]
+                if site not in fake.sites or self.path.split("?")[0] != f"/ctrl/dial/web/{site}":
+                    self._reply(404, b"not found", "text/plain")
+                    return
+                if fake.latency:
+                    sleep(fake.latency)
+                if self._flaky():
+                    return
+                with fake._lock:
+                    fake.page_loads[site] += 1
+                page = DIAL_PAGE.format(token=fake.token, analytics=fake.analytics_url).encode()
+                self._reply(200, page, "text/html; charset=utf-8")
+
+            def do_POST(self):
+                site = self.path[:-len("/mark")].rsplit("/", 1)[-1]
+                if site not in fake.sites or self.path != f"/ctrl/dial/web/{site}/mark":
+                    self._reply(404, b"not found", "text/plain")
+                    return
+                length = int(self.headers.get("Content-Length", 0))
+                form = {k: v[0] for k, v in parse_qs(self.rfile.read(length).decode()).items()}
+                if fake.latency:
+                    sleep(fake.latency)
+                if self._flaky():
+                    return
+                if form.get("_token") != fake.token:
+                    self._json(403, {"status": "error", "message": "Token inválido"})
+                    return
+                if form.get("action") not in ("ENTRADA", "SALIDA") or not form.get("rut"):
+                    self._json(400, {"status": "error", "message": "Marcaje incompleto"})
+                    return
+                with fake._lock:
+                    fake.marks.append({"action": form["action"], "rut": form["rut"].lower(), "site": site})
+                self._json(200, {"status": "success", "message": f"{form['action']} registrada"})
+
+        return Handler
+
+    def start(self) -> "FakeDialServer":
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self) -> "FakeDialServer":
+        return self.start()
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
+
+
+class FakeSMTPServer:
+    """Sumidero SMTP local: anuncia AUTH PLAIN sin STARTTLS y guarda cada mensaje recibido"""
+
+    def __init__(self, port: int = 0):
+        self.messages = []
+        self.connections = 0
+        self._lock = threading.Lock()
+        self._server = socketserver.ThreadingTCPServer(("127.0.0.1", port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def port(self) -> int:
+        return self._server.server_address[1]
+
+    def _handler(self):
+        fake = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def reply(self, line: str) -> None:
+                self.wfile.write(f"{line}\r\n".encode())
+
+            def handle(self):
+                with fake._lock:
+                    fake.connections += 1
+                self.reply("220 localhost fake smtp")
+                while True:
+                    line = self.rfile.readline()
+                    if not line:
+                        return
+                    command = line.decode(errors="replace").strip().upper()
+                    if command.startswith(("EHLO", "HELO")):
+                        self.reply("250-localhost")
+                        self.reply("250 AUTH PLAIN LOGIN")
+                    elif command.startswith("AUTH"):
+                        self.reply("235 2.7.0 Authentication successful")
+                    elif command == "DATA":
+                        self.reply("354 End data with <CR><LF>.<CR><LF>")
+                        data = []
+                        for raw in iter(self.rfile.readline, b""):
+                            if raw in (b".\r\n", b".\n"):
+                                break
+                            data.append(raw[1:] if raw.startswith(b"..") else raw)
+                        with fake._lock:
+                            fake.messages.append(message_from_bytes(b"".join(data)))
+                        self.reply("250 OK")
+                    elif command == "QUIT":
+                        self.reply("221 Bye")
+                        return
+                    else:
+                        self.reply("250 OK")
+
+        return Handler
+
+    def start(self) -> "FakeSMTPServer":
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self) -> "FakeSMTPServer":
+        return self.start()
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
+
+
+class FakeHolidayAPI:
+    """Endpoint de feriados con la respuesta de api.boostr.cl y soporte de ETag"""
+
+    def __init__(self, holidays: List[Dict] = None, port: int = 0):
+        self.holidays = holidays or []
+        self.requests = 0
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), self._handler())
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/holidays.json"
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                fake.requests += 1
+                etag = f'"{len(fake.holidays)}"'
+                if self.headers.get("If-None-Match") == etag:
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                body = json.dumps({"status": "success", "data": fake.holidays}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.send_header("ETag", etag)
+                self.end_headers()
+                self.wfile.write(body)
+
+        return Handler
+
+    def start(self) -> "FakeHolidayAPI":
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self) -> "FakeHolidayAPI":
+        return self.start()
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
+
+
+def write_ld_flag_file(path: str, ruts: List[str], endpoints: Dict[str, str] = None) -> None:
+    """Escribe los RUTs como flags activos para LD_MODE=file; con endpoints, el valor es su página de marcaje"""
+    endpoints = endpoints or {}
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"flagValues": {rut: endpoints.get(rut, True) for rut in ruts}}, f)
+
+
+if __name__ == "__main__":
+    server = FakeDialServer(port=8765).start()
+    print(f"🧪 Página de marcaje falsa en: {server.dial_url}")
+    print(f"   DIAL_URL={server.dial_url} SUBMIT_ENGINE=http python main.py")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.stop()
@@ -1,93 +1,166 @@
+from __future__ import annotations
+
 import random
+import re
+import sys
+import heapq
 import os
-import smtplib
+import hashlib
+import json
 import logging
-import requests
-import urllib3
-import ldclient
 import threading
+import atexit
+import queue
 import pytz
+from collections import deque
+from logging.handlers import QueueHandler, QueueListener
 from datetime import datetime, date
 from dotenv import load_dotenv
-from ldclient import Context
-from ldclient.config import Config
-from time import sleep
-from email.message import EmailMessage
-from selenium import webdriver
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.common.by import By
-from typing import List, Dict
+from time import sleep, monotonic, time, perf_counter
+from typing import List, Dict, Tuple, Iterator, Optional, Callable, TYPE_CHECKING
+from contextlib import contextmanager, nullcontext
 from datetime import datetime, timezone, timedelta
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, Future
+from procstats import percentile, tree_rss_kb
+
+# selenium, ldclient, requests, smtplib y asyncio se importan recién en el camino que los usa,
+# así una ejecución que termina temprano (script inactivo, feriado, sin RUTs) no los carga
+if TYPE_CHECKING:
+    import smtplib
+    from selenium.webdriver.chrome.options import Options
+    from email.message import EmailMessage
+    import requests
+    from ldclient.config import Config
+    from selenium import webdriver
+
+
+def load_requests():
+    """Importa requests la primera vez que se sale a la red"""
+    import requests
+    import requests.adapters
+    import urllib3
+    # Disable only the single InsecureRequestWarning from urllib3
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+    return requests
 
-# Disable only the single InsecureRequestWarning from urllib3
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+# Load environment variables from .env file
+load_dotenv()
 
 # Create logs directory if it doesn't exist
-logs_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "logs")
+logs_dir = os.getenv('LOGS_DIR') or os.path.join(os.path.dirname(os.path.abspath(__file__)), "logs")
 os.makedirs(logs_dir, exist_ok=True)
 
 # Generate log filename with pattern
 current_date = datetime.now().strftime('%Y-%m-%d')
 
 # If in GitHub Actions use run number, otherwise use '*'
-log_filename = f"marcaje-logs-{os.getenv('GITHUB_RUN_NUMBER', '*')}-{current_date}.log"
+RUN_ID = os.getenv('GITHUB_RUN_NUMBER', '*')
+log_filename = f"marcaje-logs-{RUN_ID}-{current_date}.log"
 log_filepath = os.path.join(logs_dir, log_filename)
 
 # CONFIGURACIÓN DE LOGS
-logging.basicConfig(
-    filename=log_filepath,
-    level=logging.INFO,
-    format="%(asctime)s-%(levelname)s-%(message)s",
-    force=True
-)
+# Los hilos solo encolan registros; un único QueueListener los escribe en consola y en logs/.
+# LOG_LEVEL=DEBUG suma el detalle por dígito y por flag, que con INFO ni siquiera se formatea.
+LOG_LEVEL = getattr(logging, os.getenv('LOG_LEVEL', 'INFO').upper(), logging.INFO)
+LOG_VERBOSE = LOG_LEVEL <= logging.DEBUG
+# Mensajes que se guardan por RUT para su correo
+RUT_LOG_LINES = int(os.getenv('RUT_LOG_LINES', '50'))
 
-logging.info(f"Iniciando logging en archivo: {log_filepath}")
+LOG = logging.getLogger("marcaje")
 
-# Load environment variables from .env file
-load_dotenv()
-print(f"🔍 DEBUG - Archivo .env cargado desde: {os.getcwd()}")
-print(f"🔍 DEBUG - DEBUG_MODE raw: '{os.getenv('DEBUG_MODE')}'")
-print(f"🔍 DEBUG - CLOCK_IN_ACTIVE raw: '{os.getenv('CLOCK_IN_ACTIVE')}'")
-
-# Get LaunchDarkly SDK key from environment
-ld_sdk_key = os.getenv('LAUNCHDARKLY_SDK_KEY')
-if not ld_sdk_key:
-    logging.error("LAUNCHDARKLY_SDK_KEY no está configurada")
-    exit(1)
-
-# Debug logging for SDK key
-logging.info("=== Iniciando configuración de LaunchDarkly ===")
-logging.info(
-    f"SDK Key encontrada (primeros 8 caracteres): {ld_sdk_key[:8]}...")
-logging.info(f"Longitud de SDK Key: {len(ld_sdk_key)}")
-
-# Remove quotes and whitespace if present
-ld_sdk_key = ld_sdk_key.strip().strip("'").strip('"')
-logging.info(
-    f"SDK Key después de limpieza (primeros 8 caracteres): {ld_sdk_key[:8]}...")
-
-# Initialize LaunchDarkly client
-try:
-    config = Config(
-        sdk_key=ld_sdk_key,
-        stream_uri="https://stream.launchdarkly.com",
-        base_uri="https://app.launchdarkly.com",
-        events_uri="https://events.launchdarkly.com",
-        offline=False
-    )
-
-    ldclient.set_config(config)
-
-    if ldclient.get().is_initialized():
-        logging.info("✅ LaunchDarkly client inicializado correctamente")
-    else:
-        logging.error("❌ LaunchDarkly client no se inicializó correctamente")
-        exit(1)
 
-except Exception as e:
-    logging.error(f"❌ Error al inicializar LaunchDarkly: {str(e)}")
-    exit(1)
+class LogContext(threading.local):
+    """RUT y fase que está atendiendo cada hilo, para etiquetar sus registros"""
+    rut = ""
+    phase = "-"
+
+    def bind(self, rut: str) -> None:
+        self.rut = rut
+        self.phase = "mark_rut" if rut else "-"
+
+    @contextmanager
+    def phase_of(self, phase: str) -> Iterator[None]:
+        previous, self.phase = self.phase, phase
+        try:
+            yield
+        finally:
+            self.phase = previous
+
+
+class RutLogBuffer:
+    """Últimos mensajes de cada RUT, para que el correo de notificación los lea directamente"""
+
+    def __init__(self, size: int):
+        self.size = size
+        self._lines: Dict[str, deque] = {}
+        self._lock = threading.Lock()
+
+    def start(self, rut: str) -> None:
+        """Empieza un buffer vacío para un RUT que se va a procesar"""
+        with self._lock:
+            self._lines[rut] = deque(maxlen=self.size)
+
+    def append(self, rut: str, line: str) -> None:
+        with self._lock:
+            lines = self._lines.get(rut)
+            if lines is not None:
+                lines.append(line)
+
+    def lines(self, rut: str) -> List[str]:
+        with self._lock:
+            return list(self._lines.get(rut, ()))
+
+
+class RutContextFilter(logging.Filter):
+    """Corre en el hilo que emite: etiqueta el registro con RUT y fase y lo copia al buffer del RUT"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        rut = LOG_CONTEXT.rut
+        record.rut = f"{rut[:4]}****" if rut else "-"
+        record.phase = LOG_CONTEXT.phase
+        # Se formatea una sola vez aquí; QueueHandler reutiliza el mensaje ya armado
+        record.msg = record.getMessage()
+        record.args = None
+        if rut and record.levelno >= logging.INFO and record.name == LOG.name:
+            RUT_LOGS.append(rut, record.msg)
+        return True
+
+
+def setup_logging(path: str) -> QueueListener:
+    """Deja la raíz de logging con un QueueHandler y arranca el único hilo que escribe"""
+    file_handler = logging.FileHandler(path, encoding="utf-8")
+    file_handler.setFormatter(logging.Formatter("%(asctime)s-%(levelname)s-[%(rut)s %(phase)s]-%(message)s"))
+    # En consola solo los mensajes del marcaje, igual que los print de antes
+    console = logging.StreamHandler(sys.stdout)
+    console.setFormatter(logging.Formatter("%(message)s"))
+    console.addFilter(lambda record: record.name == LOG.name)
+
+    records: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+    handler = QueueHandler(records)
+    handler.addFilter(RutContextFilter())
+    root = logging.getLogger()
+    for old in root.handlers[:]:
+        root.removeHandler(old)
+    root.addHandler(handler)
+    root.setLevel(logging.INFO)
+    LOG.setLevel(LOG_LEVEL)
+
+    listener = QueueListener(records, file_handler, console)
+    listener.start()
+    # atexit corre en orden inverso: el listener se detiene al final, después del outbox
+    atexit.register(listener.stop)
+    return listener
+
+
+LOG_CONTEXT = LogContext()
+RUT_LOGS = RutLogBuffer(RUT_LOG_LINES)
+LOG_LISTENER = setup_logging(log_filepath)
+
+logging.info(f"Iniciando logging en archivo: {log_filepath}")
+
+LOG.info(f"🔍 DEBUG - Archivo .env cargado desde: {os.getcwd()}")
+LOG.info(f"🔍 DEBUG - DEBUG_MODE raw: '{os.getenv('DEBUG_MODE')}'")
+LOG.info(f"🔍 DEBUG - CLOCK_IN_ACTIVE raw: '{os.getenv('CLOCK_IN_ACTIVE')}'")
 
 # Now you can access the variables using os.getenv
 clock_in_active = os.getenv('CLOCK_IN_ACTIVE')
@@ -100,10 +173,10 @@ DEBUG_MODE = debug_mode.lower() == "true" if debug_mode else False
 CLOCK_IN_ACTIVE = clock_in_active.lower() == "true" if clock_in_active else False
 
 # Agregar debug para verificar valores
-print(f"🔍 DEBUG - Variable debug_mode cargada: '{debug_mode}'")
-print(f"🔍 DEBUG - Variable DEBUG_MODE calculada: {DEBUG_MODE}")
-print(f"🔍 DEBUG - Variable clock_in_active cargada: '{clock_in_active}'")
-print(f"🔍 DEBUG - Variable CLOCK_IN_ACTIVE calculada: {CLOCK_IN_ACTIVE}")
+LOG.info(f"🔍 DEBUG - Variable debug_mode cargada: '{debug_mode}'")
+LOG.info(f"🔍 DEBUG - Variable DEBUG_MODE calculada: {DEBUG_MODE}")
+LOG.info(f"🔍 DEBUG - Variable clock_in_active cargada: '{clock_in_active}'")
+LOG.info(f"🔍 DEBUG - Variable CLOCK_IN_ACTIVE calculada: {CLOCK_IN_ACTIVE}")
 
 EMAIL = email_address
 EMAIL_PASS = email_pass
@@ -111,8 +184,147 @@ EMAIL_PASS = email_pass
 # CONFIGURACIÓN DEL CORREO
 EMAIL_FROM = EMAIL
 EMAIL_TO = EMAIL
-SMTP_SERVER = "smtp.gmail.com"
-SMTP_PORT = 587
+SMTP_SERVER = os.getenv('SMTP_SERVER', "smtp.gmail.com")
+SMTP_PORT = int(os.getenv('SMTP_PORT', '587'))
+SMTP_STARTTLS = os.getenv('SMTP_STARTTLS', 'true').lower() == "true"
+SMTP_TIMEOUT = 30
+# Junta los resultados de todos los RUTs de una ejecución en un solo correo
+EMAIL_DIGEST = os.getenv('EMAIL_DIGEST', 'false').lower() == "true"
+
+CACHE_DIR = os.getenv('CACHE_DIR') or os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache")
+
+# CONFIGURACIÓN DEL NAVEGADOR
+DIAL_URL = os.getenv('DIAL_URL', "https://app.ctrlit.cl/ctrl/dial/web/K1NBpBqyjf")
+# Página de marcaje por RUT: el flag de LaunchDarkly puede traer, en vez de true, la URL del dial
+# o solo el código de sitio de ctrlit; DIAL_ENDPOINTS_FILE (JSON {rut: url o sitio}) cubre los flags booleanos
+DIAL_ENDPOINTS_FILE = os.getenv('DIAL_ENDPOINTS_FILE', '')
+# Concurrencia adaptativa: la cantidad de Chromes simultáneos sigue a la RAM libre, las CPUs
+# y el RSS observado por sesión; MAX_BROWSERS pasa a ser solo el techo
+ADAPTIVE_CONCURRENCY = os.getenv('ADAPTIVE_CONCURRENCY', 'true').lower() == "true"
+SESSIONS_PER_CPU = float(os.getenv('SESSIONS_PER_CPU', '2'))
+SESSION_RSS_ESTIMATE_MB = float(os.getenv('SESSION_RSS_ESTIMATE_MB', '300'))
+MEMORY_RESERVE_MB = float(os.getenv('MEMORY_RESERVE_MB', '512'))
+LATENCY_PRESSURE_FACTOR = float(os.getenv('LATENCY_PRESSURE_FACTOR', '2'))
+MAX_BROWSERS = int(os.getenv(
+    'MAX_BROWSERS',
+    str(max(5, int((os.cpu_count() or 1) * SESSIONS_PER_CPU))) if ADAPTIVE_CONCURRENCY else '5'))
+# Perfil liviano de Chrome: carga "eager", bloqueo por CDP de imágenes, fuentes, media y dominios
+# de terceros (el CSS no se bloquea: la página de marcaje lo usa para mostrar u ocultar el teclado)
+BROWSER_PAGE_LOAD_STRATEGY = os.getenv('BROWSER_PAGE_LOAD_STRATEGY', 'eager')
+BLOCK_RESOURCES = os.getenv('BLOCK_RESOURCES', 'true').lower() == "true"
+BLOCKED_RESOURCE_TYPES = os.getenv(
+    'BLOCKED_RESOURCE_TYPES', 'png,jpg,jpeg,gif,webp,svg,ico,woff,woff2,ttf,otf,mp4,webm,mp3')
+BLOCKED_DOMAINS = os.getenv(
+    'BLOCKED_DOMAINS',
+    'google-analytics.com,googletagmanager.com,doubleclick.net,facebook.net,hotjar.com,'
+    'fonts.googleapis.com,fonts.gstatic.com')
+# Directorio con un perfil de Chrome por slot del pool (Chrome no comparte un perfil entre procesos);
+# vacío usa un perfil temporal por sesión. Queda fuera de .cache/ para que el workflow no suba
+# perfiles, caché de disco ni cookies de ctrlit al caché de Actions
+BROWSER_PROFILE_DIR = os.getenv(
+    'BROWSER_PROFILE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), ".chrome-profiles"))
+BROWSER_DISK_CACHE_MB = int(os.getenv('BROWSER_DISK_CACHE_MB', '20'))
+# Cantidad de marcajes que atiende una sesión de Chrome antes de reciclarla
+BROWSER_MAX_USES = int(os.getenv('BROWSER_MAX_USES', '20'))
+# Segundos que una página de marcaje cargada puede esperar en el pool antes de recargarla
+BROWSER_PAGE_MAX_AGE = float(os.getenv('BROWSER_PAGE_MAX_AGE', '600'))
+# Elemento del teclado que muestra el RUT tipeado; sin él no se puede reutilizar la página sin recargarla
+DIAL_ECHO_SELECTOR = os.getenv('DIAL_ECHO_SELECTOR', '#echo')
+# Tiempos máximos (segundos) de cada espera por condición en la página de marcaje
+WAIT_PAGE_TIMEOUT = float(os.getenv('WAIT_PAGE_TIMEOUT', '15'))
+WAIT_KEYPAD_TIMEOUT = float(os.getenv('WAIT_KEYPAD_TIMEOUT', '10'))
+WAIT_SUBMIT_TIMEOUT = float(os.getenv('WAIT_SUBMIT_TIMEOUT', '5'))
+# Espera a que una página de marcaje ya cargada vuelva a la pantalla inicial antes de recargarla
+WAIT_RESET_TIMEOUT = float(os.getenv('WAIT_RESET_TIMEOUT', '2'))
+WAIT_POLL_INTERVAL = 0.1
+# Reintentos por fase del marcaje y corte de circuito cuando ctrlit no responde
+RETRY_ATTEMPTS = max(1, int(os.getenv('RETRY_ATTEMPTS', '3')))
+RETRY_BASE_SECONDS = float(os.getenv('RETRY_BASE_SECONDS', '0.5'))
+RETRY_MAX_SECONDS = float(os.getenv('RETRY_MAX_SECONDS', '8'))
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv('CIRCUIT_FAILURE_THRESHOLD', '8'))
+CIRCUIT_COOLDOWN_SECONDS = float(os.getenv('CIRCUIT_COOLDOWN_SECONDS', '60'))
+
+# MOTOR DE MARCAJE: "selenium" (navegador) o "http" (sin navegador, con Selenium como respaldo)
+SUBMIT_ENGINE = os.getenv('SUBMIT_ENGINE', 'selenium').strip().lower()
+SUBMIT_FALLBACK = os.getenv('SUBMIT_FALLBACK', 'true').lower() == "true"
+# Vacío: el POST va a "{página de marcaje del RUT}/mark"
+HTTP_SUBMIT_URL = os.getenv('HTTP_SUBMIT_URL', '')
+HTTP_TIMEOUT = float(os.getenv('HTTP_TIMEOUT', '10'))
+# Texto que confirma el marcaje en una respuesta que no es JSON; sin él solo vale {"status": "success"/"ok"}
+HTTP_SUCCESS_MARKER = os.getenv('HTTP_SUCCESS_MARKER', '')
+HTTP_USER_AGENT = "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Safari/537.36"
+CSRF_TOKEN_RE = re.compile(r'name="(?:_token|csrf-token)"\s+(?:value|content)="([^"]+)"')
+
+# MOTOR DE EJECUCIÓN: "threads" (pool de hilos) o "asyncio" (corrutinas con semáforo)
+RUN_ENGINE = os.getenv('RUN_ENGINE', 'threads').strip().lower()
+
+# SHARDING: cada proceso atiende solo los RUTs cuyo hash cae en su shard (SHARD_INDEX de 0 a SHARD_COUNT-1)
+SHARD_INDEX = int(os.getenv('SHARD_INDEX', '0'))
+SHARD_COUNT = max(1, int(os.getenv('SHARD_COUNT', '1')))
+if not 0 <= SHARD_INDEX < SHARD_COUNT:
+    # Un índice fuera de rango no marca a nadie y deja un archivo que el merge nunca lee
+    raise SystemExit(f"❌ SHARD_INDEX={SHARD_INDEX} fuera de rango para SHARD_COUNT={SHARD_COUNT} (0..{SHARD_COUNT - 1})")
+# Con SHARD_MERGE=true el script no marca: solo junta los resultados de los shards
+SHARD_MERGE = os.getenv('SHARD_MERGE', 'false').lower() == "true"
+
+# Con RANDOM_DELAYS=false todos los RUTs parten de inmediato (benchmarks, pruebas locales)
+RANDOM_DELAYS = os.getenv('RANDOM_DELAYS', 'true').lower() == "true"
+
+# Tiempos por fase (JSON lines en logs/phases-*.jsonl); desactivado no agrega costo
+PHASE_TIMINGS = os.getenv('PHASE_TIMINGS', 'true').lower() == "true"
+# Ruta .prom para el textfile collector de node_exporter; vacío no exporta métricas
+METRICS_TEXTFILE = os.getenv('METRICS_TEXTFILE', '')
+
+# MODO DAEMON: proceso residente que dispara las ventanas de marcaje (lunes a viernes, hora Chile)
+DAEMON_MODE = os.getenv('DAEMON_MODE', 'false').lower() == "true"
+
+# LAUNCHDARKLY: "stream" (por defecto), "polling", "file" (LD_FLAG_FILE) o "snapshot"
+# (usa el último estado guardado mientras tenga menos de LD_SNAPSHOT_MAX_AGE_MINUTES)
+LD_MODE = os.getenv('LD_MODE', 'stream').strip().lower()
+LD_FLAG_FILE = os.getenv('LD_FLAG_FILE', 'flags.json')
+LD_SNAPSHOT_FILE = os.path.join(CACHE_DIR, "ld_flags.json")
+LD_SNAPSHOT_MAX_AGE_MINUTES = float(os.getenv('LD_SNAPSHOT_MAX_AGE_MINUTES', '60'))
+# Antigüedad máxima del snapshot que se acepta cuando LaunchDarkly no responde
+LD_SNAPSHOT_FALLBACK_HOURS = float(os.getenv('LD_SNAPSHOT_FALLBACK_HOURS', '72'))
+
+# PLANIFICADOR: ajusta los delays con el historial de tiempos de servicio para terminar antes del límite
+PLANNER = os.getenv('PLANNER', 'true').lower() == "true"
+SERVICE_HISTORY_FILE = os.path.join(CACHE_DIR, "service_times.sqlite")
+SERVICE_TIME_DEFAULT_SECONDS = float(os.getenv('SERVICE_TIME_DEFAULT_SECONDS', '20'))
+# Límite relativo al inicio de la ejecución y, opcional, una hora fija por acción ("08:45")
+RUN_DEADLINE_MINUTES = float(os.getenv('RUN_DEADLINE_MINUTES', '25'))
+
+
+def parse_clock(name: str) -> Optional[Tuple[int, int]]:
+    """Lee una hora "HH:MM" del entorno; mal formada detiene el script al iniciar y no a mitad de la ejecución"""
+    value = os.getenv(name, '').strip()
+    if not value:
+        return None
+    try:
+        hour, minute = (int(part) for part in value.split(":"))
+        datetime(2000, 1, 1, hour, minute)
+    except ValueError:
+        raise SystemExit(f"❌ {name} inválido: {value!r} (se espera HH:MM)")
+    return hour, minute
+
+
+DEADLINE_ENTRADA = parse_clock('DEADLINE_ENTRADA')
+DEADLINE_SALIDA = parse_clock('DEADLINE_SALIDA')
+
+# Diario de marcajes exitosos para que una re-ejecución no repita RUTs ya marcados
+MARK_JOURNAL = os.getenv('MARK_JOURNAL', 'true').lower() == "true"
+MARK_JOURNAL_FILE = os.path.join(CACHE_DIR, "mark_journal.jsonl")
+MARK_JOURNAL_RETENTION_DAYS = int(os.getenv('MARK_JOURNAL_RETENTION_DAYS', '7'))
+
+# CALENDARIO DE FERIADOS
+HOLIDAY_API_URL = os.getenv('HOLIDAY_API_URL', "https://api.boostr.cl/holidays.json")
+HOLIDAY_CACHE_FILE = os.path.join(CACHE_DIR, "holidays.json")
+HOLIDAY_CACHE_TTL_HOURS = float(os.getenv('HOLIDAY_CACHE_TTL_HOURS', '24'))
+HOLIDAY_SOURCES = {
+    "API": "API en línea",
+    "CACHE": "Caché local de la API",
+    "LOCAL": "Lista local (API no disponible)",
+}
 
 CHILE_HOLIDAYS_2025 = [
     {"date": "2025-01-01", "title": "Año Nuevo", "type": "Civil"},
@@ -130,56 +342,463 @@ CHILE_HOLIDAYS_2025 = [
 ]
 
 
-def is_holiday():
-    print("🎄 Verificando si hoy es feriado...")
-    try:
-        print("🌐 Consultando API de feriados online...")
-        headers = {'accept': 'application/json'}
-        response = requests.get(
-            'https://api.boostr.cl/holidays.json', headers=headers, timeout=5)
+class _Span:
+    __slots__ = ("timer", "key", "phase", "started_at", "start")
+
+    def __init__(self, timer: "PhaseTimer", key: str, phase: str):
+        self.timer = timer
+        self.key = key
+        self.phase = phase
+
+    def __enter__(self) -> "_Span":
+        self.started_at = time()
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        self.timer._record(self.key, self.phase, self.started_at,
+                           perf_counter() - self.start, exc_type is None)
+        return False
+
+
+class PhaseTimer:
+    """Cronómetro por fase; cada hilo mide bajo la clave que tenga asociada (un RUT, "outbox" o "run")"""
+
+    def __init__(self, enabled: bool):
+        self.enabled = enabled
+        self.events: List[Dict] = []
+        # Segundos acumulados por clave y fase, para no recorrer todos los eventos en cada RUT
+        self._totals: Dict[str, Dict[str, float]] = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def bind(self, key: str) -> None:
+        """Asocia las próximas mediciones de este hilo a una clave"""
+        self._local.key = key
+
+    def span(self, phase: str):
+        """Mide el bloque `with`; deshabilitado devuelve un contexto vacío compartido"""
+        if not self.enabled:
+            return NULL_SPAN
+        return _Span(self, getattr(self._local, "key", "run"), phase)
+
+    def record(self, phase: str, started_at: float, seconds: float, ok: bool = True) -> None:
+        """Registra una medición tomada por fuera de span(), bajo la clave del hilo"""
+        if self.enabled:
+            self._record(getattr(self._local, "key", "run"), phase, started_at, seconds, ok)
+
+    def _record(self, key: str, phase: str, started_at: float, seconds: float, ok: bool) -> None:
+        with self._lock:
+            self.events.append({"key": key, "phase": phase, "started_at": round(started_at, 3),
+                                "seconds": round(seconds, 4), "ok": ok})
+            totals = self._totals.setdefault(key, {})
+            totals[phase] = round(totals.get(phase, 0.0) + round(seconds, 4), 4)
+
+    def phases_for(self, key: str) -> Dict[str, float]:
+        """Segundos totales por fase de una clave"""
+        with self._lock:
+            return dict(self._totals.get(key, {}))
+
+    def flush(self, path: str) -> None:
+        """Agrega las mediciones pendientes al archivo JSON lines y las descarta de memoria"""
+        with self._lock:
+            events, self.events = self.events, []
+            self._totals = {}
+        if not events:
+            return
+        with open(path, "a", encoding="utf-8") as f:
+            for event in events:
+                f.write(json.dumps(event) + "\n")
+        LOG.info(f"⏱️ Tiempos por fase guardados en: {path}")
+
+
+NULL_SPAN = nullcontext()
+PHASES = PhaseTimer(PHASE_TIMINGS)
+
+
+class ServiceClock:
+    """Tiempo de servicio del RUT de cada hilo: solo lo que pasa con una sesión ya tomada del pool.
+
+    Deja fuera la espera de admisión y de un navegador libre, que depende de la carga de la
+    ejecución y no del RUT; con respaldo a Selenium suma ambos intentos.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def reset(self) -> None:
+        self._local.seconds = None
+
+    @contextmanager
+    def measure(self) -> Iterator[None]:
+        started = perf_counter()
+        try:
+            yield
+        finally:
+            self._local.seconds = (getattr(self._local, "seconds", None) or 0.0) + perf_counter() - started
+
+    def seconds(self) -> Optional[float]:
+        return getattr(self._local, "seconds", None)
+
 
-        if response.status_code == 200:
-            print("✅ API de feriados respondió correctamente")
+SERVICE_CLOCK = ServiceClock()
+
+
+class EmailOutbox:
+    """Cola de correos atendida por un solo hilo que reutiliza una conexión SMTP autenticada"""
+
+    def __init__(self, digest: bool = False):
+        self.digest = digest
+        self.sent = 0
+        self.failed = 0
+        self.outcomes: Dict[str, str] = {}
+        self._queue: "queue.Queue[Optional[Tuple[EmailMessage, List[str]]]]" = queue.Queue()
+        self._digest_items: List[Tuple[EmailMessage, List[str]]] = []
+        self._lock = threading.Lock()
+        self._smtp: Optional[smtplib.SMTP] = None
+        self._thread: Optional[threading.Thread] = None
+        self._closed = False
+
+    def send(self, email: EmailMessage, digest: bool = False, key: Optional[str] = None) -> None:
+        """Encola un correo; nunca bloquea ni lanza excepciones hacia el marcaje.
+
+        `key` (normalmente el RUT) permite consultar después en `outcomes` si el correo salió.
+        """
+        keys = [key] if key else []
+        try:
+            with self._lock:
+                for k in keys:
+                    self.outcomes[k] = "queued"
+                if self.digest and digest:
+                    self._digest_items.append((email, keys))
+                    return
+            self._enqueue(email, keys)
+        except Exception as e:
+            logging.error(f"No se pudo encolar correo: {str(e)}")
+
+    def _enqueue(self, email: EmailMessage, keys: List[str]) -> None:
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="outbox", daemon=True)
+                self._thread.start()
+        self._queue.put((email, keys))
+
+    def _connect(self) -> smtplib.SMTP:
+        import smtplib
+        with PHASES.span("smtp_connect"):
+            smtp = smtplib.SMTP(SMTP_SERVER, SMTP_PORT, timeout=SMTP_TIMEOUT)
+            if SMTP_STARTTLS:
+                smtp.starttls()
+            smtp.login(EMAIL_FROM, EMAIL_PASS)
+        return smtp
+
+    def _disconnect(self) -> None:
+        if self._smtp is not None:
+            try:
+                self._smtp.quit()
+            except Exception:
+                pass
+            self._smtp = None
+
+    def _deliver(self, email: EmailMessage, keys: List[str]) -> None:
+        # Un reintento con conexión nueva cubre el caso de Gmail cerrando la sesión ociosa
+        for attempt in (1, 2):
+            try:
+                if self._smtp is None:
+                    self._smtp = self._connect()
+                with PHASES.span("smtp_send"):
+                    self._smtp.send_message(email)
+                self.sent += 1
+                self._set_outcome(keys, "sent")
+                return
+            except Exception as e:
+                self._disconnect()
+                if attempt == 2:
+                    self.failed += 1
+                    self._set_outcome(keys, "failed")
+                    LOG.error(f"❌ No se pudo enviar correo '{email['Subject']}': {str(e)}")
+                    logging.error(
+                        f"No se pudo enviar correo '{email['Subject']}': {str(e)}")
+
+    def _set_outcome(self, keys: List[str], outcome: str) -> None:
+        with self._lock:
+            for k in keys:
+                self.outcomes[k] = outcome
+
+    def _run(self) -> None:
+        PHASES.bind("outbox")
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                break
+            try:
+                self._deliver(*item)
+            finally:
+                self._queue.task_done()
+        self._disconnect()
+
+    def _build_digest(self) -> Optional[Tuple[EmailMessage, List[str]]]:
+        from email.message import EmailMessage
+        with self._lock:
+            items, self._digest_items = self._digest_items, []
+        if not items:
+            return None
+        failed = sum(1 for item, _ in items if str(item["Subject"]).startswith("Error"))
+        email = EmailMessage()
+        email["From"] = EMAIL_FROM
+        email["To"] = EMAIL_TO
+        email["Subject"] = f"📋 Resumen de marcaje: {len(items) - failed} OK, {failed} con error"
+        sections = [f"=== {item['Subject']} ===\n{item.get_content().strip()}" for item, _ in items]
+        email.set_content("\n\n".join(sections))
+        return email, [k for _, keys in items for k in keys]
+
+    def flush_digest(self) -> None:
+        """Encola el resumen con los resultados acumulados hasta ahora"""
+        digest = self._build_digest()
+        if digest is not None:
+            self._enqueue(*digest)
+
+    def drain(self) -> None:
+        """Espera a que salga todo lo encolado sin cerrar el outbox (el daemon lo sigue usando)"""
+        if self._thread is not None:
+            self._queue.join()
+
+    def close(self) -> None:
+        """Envía el resumen pendiente y espera a que se vacíe la cola"""
+        if self._closed:
+            return
+        self.flush_digest()
+        self._closed = True
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            LOG.info(f"📧 Correos enviados: {self.sent} | fallidos: {self.failed}")
+
+
+OUTBOX = None
+OUTBOX_LOCK = threading.Lock()
+
+
+def get_outbox() -> EmailOutbox:
+    """Crea el outbox la primera vez que se necesita; se vacía al terminar el script"""
+    global OUTBOX
+    with OUTBOX_LOCK:
+        if OUTBOX is None:
+            OUTBOX = EmailOutbox(digest=EMAIL_DIGEST)
+            atexit.register(OUTBOX.close)
+        return OUTBOX
+
+
+def easter_sunday(year: int) -> date:
+    """Domingo de Pascua (algoritmo gregoriano anónimo)"""
+    a = year % 19
+    b, c = divmod(year, 100)
+    d, e = divmod(b, 4)
+    f = (b + 8) // 25
+    g = (b - f + 1) // 3
+    h = (19 * a + b - d - g + 15) % 30
+    i, k = divmod(c, 4)
+    l = (32 + 2 * e + 2 * i - h - k) % 7
+    m = (a + 11 * h + 22 * l) // 451
+    month, day = divmod(h + l - 7 * m + 114, 31)
+    return date(year, month, day + 1)
+
+
+def moved_to_monday(day: date) -> date:
+    """Ley 19.668: de martes a jueves pasa al lunes anterior y el viernes al lunes siguiente"""
+    weekday = day.weekday()
+    if 1 <= weekday <= 3:
+        return day - timedelta(days=weekday)
+    if weekday == 4:
+        return day + timedelta(days=3)
+    return day
+
+
+def winter_solstice(year: int) -> date:
+    """Día del solsticio de invierno en hora de Chile (fórmula media de Meeus, error de minutos)"""
+    y = (year - 2000) / 1000
+    jde = 2451716.56767 + 365241.62603 * y + 0.00325 * y ** 2 - 0.00888 * y ** 3 - 0.00030 * y ** 4
+    # Día juliano 2451545.0 es el 2000-01-01 12:00 UTC
+    instant = datetime(2000, 1, 1, 12, tzinfo=pytz.utc) + timedelta(days=jde - 2451545.0)
+    return instant.astimezone(pytz.timezone('America/Santiago')).date()
+
+
+def evangelical_churches_day(year: int) -> date:
+    """Ley 20.299: el 31 de octubre, salvo martes (pasa al viernes 27) o miércoles (al viernes 2)"""
+    day = date(year, 10, 31)
+    if day.weekday() == 1:
+        return day - timedelta(days=4)
+    if day.weekday() == 2:
+        return day + timedelta(days=2)
+    return day
+
+
+def local_holidays(year: int) -> Dict[str, Dict]:
+    """Feriados calculables sin API: fechas fijas, Semana Santa y los que se mueven por ley.
+
+    Las elecciones y los feriados extraordinarios solo llegan por la API.
+    """
+    easter = easter_sunday(year)
+    holidays = [
+        (date(year, 1, 1), "Año Nuevo", "Civil"),
+        (easter - timedelta(days=2), "Viernes Santo", "Religioso"),
+        (easter - timedelta(days=1), "Sábado Santo", "Religioso"),
+        (date(year, 5, 1), "Día Nacional del Trabajo", "Civil"),
+        (date(year, 5, 21), "Día de las Glorias Navales", "Civil"),
+        (moved_to_monday(date(year, 6, 29)), "San Pedro y San Pablo", "Religioso"),
+        (date(year, 7, 16), "Día de la Virgen del Carmen", "Religioso"),
+        (date(year, 8, 15), "Asunción de la Virgen", "Religioso"),
+        (date(year, 9, 18), "Independencia Nacional", "Civil"),
+        (date(year, 9, 19), "Día de las Glorias del Ejército", "Civil"),
+        (moved_to_monday(date(year, 10, 12)), "Encuentro de Dos Mundos", "Civil"),
+        (evangelical_churches_day(year), "Día de las Iglesias Evangélicas y Protestantes", "Religioso"),
+        (date(year, 11, 1), "Día de Todos los Santos", "Religioso"),
+        (date(year, 12, 8), "Inmaculada Concepción", "Religioso"),
+        (date(year, 12, 25), "Navidad", "Religioso"),
+    ]
+    if year >= 2021:
+        # Ley 21.357: el día del solsticio, salvo 2021 que la ley fijó el lunes 21 de junio
+        solstice = date(2021, 6, 21) if year == 2021 else winter_solstice(year)
+        holidays.append((solstice, "Día Nacional de los Pueblos Indígenas", "Civil"))
+    by_date = {d.isoformat(): {"date": d.isoformat(), "title": title, "type": kind}
+               for d, title, kind in holidays}
+    if year == 2025:
+        by_date.update({h["date"]: h for h in CHILE_HOLIDAYS_2025})
+    return by_date
+
+
+class HolidayCalendar:
+    """Feriados de varios años indexados por fecha, con caché en disco de la API y revalidación condicional"""
+
+    def __init__(self, cache_path: str, ttl_seconds: float):
+        self.cache_path = cache_path
+        self.ttl_seconds = ttl_seconds
+        self.fetched_at = 0.0
+        self.etag: Optional[str] = None
+        self.last_modified: Optional[str] = None
+        self.refreshed = False
+        self._by_date: Dict[str, Dict] = {}
+        self._years = set()
+        self._load()
+
+    def _index(self, holidays: Dict[str, Dict]) -> None:
+        self._by_date = holidays
+        self._years = {int(day[:4]) for day in holidays}
+
+    def _load(self) -> None:
+        try:
+            with open(self.cache_path, encoding="utf-8") as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            return
+        self.fetched_at = cache.get("fetched_at", 0.0)
+        self.etag = cache.get("etag")
+        self.last_modified = cache.get("last_modified")
+        self._index(cache.get("holidays", {}))
+
+    def _save(self) -> None:
+        os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+        tmp_path = f"{self.cache_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({
+                "fetched_at": self.fetched_at,
+                "etag": self.etag,
+                "last_modified": self.last_modified,
+                "holidays": self._by_date,
+            }, f, ensure_ascii=False)
+        os.replace(tmp_path, self.cache_path)
+
+    def is_stale(self) -> bool:
+        return time() - self.fetched_at > self.ttl_seconds
+
+    def refresh(self) -> None:
+        """Consulta la API con If-None-Match/If-Modified-Since y agrega lo nuevo al índice"""
+        headers = {'accept': 'application/json'}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        response = load_requests().get(HOLIDAY_API_URL, headers=headers, timeout=5)
+
+        if response.status_code == 304:
+            LOG.info("✅ Caché de feriados sigue vigente (304)")
+        elif response.status_code == 200:
             result = response.json()
-            if result['status'] == 'success':
-                holidays = result['data']
-                today = date.today().strftime("%Y-%m-%d")
-                print(f"📅 Verificando fecha: {today}")
-
-                holiday = next(
-                    (h for h in holidays if h['date'] == today), None)
-                if holiday:
-                    print(
-                        f"🎉 ¡Hoy es feriado!: {holiday['title']} ({holiday['type']})")
-                    send_holiday_email(holiday, "API")
-                    return True
-                else:
-                    print("📅 No es feriado según API online")
-            else:
+            if result['status'] != 'success':
                 raise Exception(
                     f"API retornó estado no exitoso: {result['status']}")
+            # Se conservan los años anteriores; la API solo entrega el año en curso
+            holidays = dict(self._by_date)
+            holidays.update({h['date']: h for h in result['data']})
+            self._index(holidays)
+            self.etag = response.headers.get('ETag')
+            self.last_modified = response.headers.get('Last-Modified')
+            LOG.info(f"✅ API de feriados respondió correctamente ({len(result['data'])} feriados)")
         else:
             raise Exception(f"API retornó status code: {response.status_code}")
 
-    except Exception as e:
-        print(f"⚠️ API de feriados no disponible: {str(e)}")
-        print("📋 Verificando con lista local de feriados...")
+        self.fetched_at = time()
+        self.refreshed = True
+        self._save()
 
-        today = date.today().strftime("%Y-%m-%d")
-        holiday = next(
-            (h for h in CHILE_HOLIDAYS_2025 if h['date'] == today), None)
+    def ensure_fresh(self) -> None:
+        """Solo va a la red cuando la caché venció; si la API falla se sigue con lo que haya"""
+        if not self.is_stale():
+            LOG.info("📦 Usando caché local de feriados")
+            return
+        try:
+            LOG.info("🌐 Consultando API de feriados online...")
+            self.refresh()
+        except Exception as e:
+            LOG.warning(f"⚠️ API de feriados no disponible: {str(e)}")
+
+    def lookup(self, day: str) -> Tuple[Optional[Dict], str]:
+        """Busca una fecha "YYYY-MM-DD" y devuelve (feriado, fuente)"""
+        if int(day[:4]) in self._years:
+            return self._by_date.get(day), "API" if self.refreshed else "CACHE"
+        LOG.warning("⚠️ Feriados calculados localmente: no incluye elecciones ni feriados extraordinarios")
+        return local_holidays(int(day[:4])).get(day), "LOCAL"
 
-        if holiday:
-            print(
-                f"🎉 ¡Hoy es feriado! (lista local): {holiday['title']} ({holiday['type']})")
-            send_holiday_email(holiday, "LOCAL")
-            return True
 
-    print("✅ No es feriado, continuando con el marcaje")
+HOLIDAY_CALENDAR = None
+
+
+def get_holiday_calendar() -> HolidayCalendar:
+    global HOLIDAY_CALENDAR
+    if HOLIDAY_CALENDAR is None:
+        HOLIDAY_CALENDAR = HolidayCalendar(HOLIDAY_CACHE_FILE, HOLIDAY_CACHE_TTL_HOURS * 3600)
+    return HOLIDAY_CALENDAR
+
+
+def is_holiday():
+    LOG.info("🎄 Verificando si hoy es feriado...")
+    calendar = get_holiday_calendar()
+    today = date.today().strftime("%Y-%m-%d")
+    LOG.info(f"📅 Verificando fecha: {today}")
+
+    # Si la caché en disco ya marca hoy como feriado, se termina sin salir a la red
+    holiday, source = calendar.lookup(today)
+    if not (holiday and source == "CACHE"):
+        with PHASES.span("holiday_check"):
+            calendar.ensure_fresh()
+        holiday, source = calendar.lookup(today)
+    if source == "LOCAL":
+        LOG.info("📋 Verificando con lista local de feriados...")
+
+    if holiday:
+        LOG.info(
+            f"🎉 ¡Hoy es feriado! ({source}): {holiday['title']} ({holiday['type']})")
+        send_holiday_email(holiday, source)
+        return True
+
+    LOG.info("✅ No es feriado, continuando con el marcaje")
     return False
 
 
 def send_holiday_email(holiday, source):
+    from email.message import EmailMessage
     try:
         email = EmailMessage()
         email["From"] = EMAIL_FROM
@@ -188,15 +807,12 @@ def send_holiday_email(holiday, source):
 
         content = f"""Hoy es feriado ({holiday['title']}), no se realizará marcaje.
 Tipo: {holiday['type']}
-Fuente: {'API en línea' if source == 'API' else 'Lista local (API no disponible)'}"""
+Fuente: {HOLIDAY_SOURCES.get(source, source)}"""
 
         email.set_content(content)
 
-        with smtplib.SMTP(SMTP_SERVER, SMTP_PORT) as smtp:
-            smtp.starttls()
-            smtp.login(EMAIL_FROM, EMAIL_PASS)
-            smtp.send_message(email)
-        logging.info(f"Correo de feriado enviado (fuente: {source})")
+        get_outbox().send(email)
+        logging.info(f"Correo de feriado encolado (fuente: {source})")
     except Exception as mail_error:
         logging.error(
             f"No se pudo enviar correo de feriado: {str(mail_error)}")
@@ -224,137 +840,1040 @@ def is_valid_rut(rut):
         return False
 
 
-def process_rut(rut: str) -> None:
+def available_memory_mb() -> Optional[float]:
+    """MemAvailable de /proc/meminfo en MB; None fuera de Linux"""
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+class AdmissionController:
+    """Semáforo de sesiones de navegador cuyo límite se recalcula con la memoria, las CPUs y la latencia.
+
+    Sube de a una sesión mientras sobre RAM y la carga de página se mantenga cerca de su mejor
+    valor; baja de inmediato si la memoria no alcanza, y de a una por cada carga lenta medida.
+    """
+
+    EWMA_ALPHA = 0.3
+    # Sin cargas nuevas en este tiempo (p. ej. páginas reutilizadas) se olvida la presión de latencia
+    LATENCY_STALE_SECONDS = 30.0
+
+    def __init__(self, ceiling: int, adaptive: bool):
+        self.ceiling = max(1, ceiling)
+        self.adaptive = adaptive
+        self.session_rss_mb = SESSION_RSS_ESTIMATE_MB
+        self.latency: Optional[float] = None
+        self.latency_baseline: Optional[float] = None
+        self.latency_at = 0.0
+        self.in_use = 0
+        self.peak = 0
+        self._cond = threading.Condition()
+        self.limit = self.ceiling
+        if adaptive:
+            self.limit = 1
+            with self._cond:
+                self._adjust(initial=True)
+
+    def _capacity(self) -> int:
+        capacity = min(self.ceiling, max(1, int((os.cpu_count() or 1) * SESSIONS_PER_CPU)))
+        available = available_memory_mb()
+        if available is not None:
+            # Las sesiones abiertas ya están descontadas de MemAvailable
+            spare = int((available - MEMORY_RESERVE_MB) // self.session_rss_mb)
+            capacity = min(capacity, self.in_use + spare)
+        return max(1, capacity)
+
+    def _adjust(self, initial: bool = False, latency_sample: bool = False) -> None:
+        """Recalcula el límite; la latencia solo lo baja cuando llega una medición nueva (`latency_sample`)"""
+        if not self.adaptive:
+            return
+        capacity = self._capacity()
+        if initial:
+            self.limit = capacity
+            return
+        if self.latency is not None and monotonic() - self.latency_at > self.LATENCY_STALE_SECONDS:
+            self.latency = None
+        pressured = (self.latency is not None and self.latency_baseline is not None
+                     and self.latency > self.latency_baseline * LATENCY_PRESSURE_FACTOR)
+        if capacity < self.limit:
+            target = capacity
+        elif pressured:
+            target = self.limit - 1 if latency_sample else self.limit
+        else:
+            target = min(capacity, self.limit + 1)
+        target = max(1, target)
+        if target != self.limit:
+            LOG.info(f"🧵 Concurrencia de navegadores: {self.limit} → {target}")
+            logging.info(
+                f"Concurrencia {self.limit} -> {target} (RSS/sesión {self.session_rss_mb:.0f} MB, "
+                f"latencia {self.latency or 0:.2f}s)")
+            self.limit = target
+            self._cond.notify_all()
+
+    def __enter__(self) -> "AdmissionController":
+        with self._cond:
+            while self.in_use >= self.limit:
+                # Se reevalúa periódicamente por si se liberó memoria mientras se espera;
+                # la latencia no vuelve a descontar aquí, solo con cada medición nueva
+                self._cond.wait(timeout=1.0)
+                self._adjust()
+            self.in_use += 1
+            self.peak = max(self.peak, self.in_use)
+        return self
+
+    def __exit__(self, *exc) -> bool:
+        with self._cond:
+            self.in_use -= 1
+            self._cond.notify()
+        return False
+
+    def observe_session(self, rss_mb: float) -> None:
+        """RSS medido de una sesión de Chrome (chromedriver + navegador)"""
+        if rss_mb <= 0:
+            return
+        with self._cond:
+            self.session_rss_mb += self.EWMA_ALPHA * (rss_mb - self.session_rss_mb)
+            self._adjust()
+
+    def observe_latency(self, seconds: float) -> None:
+        """Tiempo de carga de la página de marcaje"""
+        with self._cond:
+            self.latency = seconds if self.latency is None else \
+                self.latency + self.EWMA_ALPHA * (seconds - self.latency)
+            self.latency_at = monotonic()
+            self.latency_baseline = min(self.latency_baseline or self.latency, self.latency)
+            self._adjust(latency_sample=True)
+
+    def reset_peak(self) -> None:
+        with self._cond:
+            self.peak = self.in_use
+
+    def snapshot(self) -> Dict:
+        with self._cond:
+            return {"adaptive": self.adaptive, "limit": self.limit, "peak": self.peak,
+                    "ceiling": self.ceiling, "session_rss_mb": round(self.session_rss_mb, 1)}
+
+
+ADMISSION = AdmissionController(MAX_BROWSERS, ADAPTIVE_CONCURRENCY)
+
+
+def blocked_url_patterns(resource_types: str, domains: str) -> List[str]:
+    """Patrones de Network.setBlockedURLs para extensiones ("png,woff2") y dominios (también subdominios)"""
+    patterns = [f"*.{ext.strip().lstrip('.')}*" for ext in resource_types.split(",") if ext.strip()]
+    for domain in (d.strip() for d in domains.split(",")):
+        if domain:
+            patterns += [f"*://{domain}*/*", f"*://*.{domain}*/*"]
+    return patterns
+
+
+def profile_in_use(user_data_dir: str) -> bool:
+    """Chrome deja SingletonLock como symlink a "host-pid": el perfil está en uso si ese proceso sigue vivo aquí"""
+    import socket
+    try:
+        target = os.readlink(os.path.join(user_data_dir, "SingletonLock"))
+    except OSError:
+        return False
+    host, _, pid = target.rpartition("-")
+    if host != socket.gethostname():
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except (ValueError, ProcessLookupError):
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class BrowserProfile:
+    """Opciones de Chrome del pool: carga eager, bloqueo de recursos por CDP y un perfil en disco por slot"""
+
+    def __init__(self, page_load_strategy: str = BROWSER_PAGE_LOAD_STRATEGY,
+                 blocked_patterns: Optional[List[str]] = None,
+                 profile_dir: str = BROWSER_PROFILE_DIR, disk_cache_mb: int = BROWSER_DISK_CACHE_MB):
+        self.page_load_strategy = page_load_strategy
+        if blocked_patterns is None:
+            blocked_patterns = blocked_url_patterns(BLOCKED_RESOURCE_TYPES, BLOCKED_DOMAINS) if BLOCK_RESOURCES else []
+        self.blocked_patterns = blocked_patterns
+        self.profile_dir = profile_dir
+        self.disk_cache_mb = disk_cache_mb
+
+    def slot_dir(self, slot: Optional[int]) -> Optional[str]:
+        if not self.profile_dir or slot is None:
+            return None
+        # El shard va en el nombre para que dos procesos en la misma máquina no compartan perfil
+        return os.path.join(self.profile_dir, f"slot-{SHARD_INDEX}-{slot}")
+
+    def options(self, slot: Optional[int]) -> Options:
+        from selenium.webdriver.chrome.options import Options
+
+        # Configure Chrome options - DESHABILITAR GEOLOCALIZACIÓN
+        options = Options()
+        options.page_load_strategy = self.page_load_strategy
+        options.add_argument("--headless")
+        options.add_argument("--no-sandbox")
+        options.add_argument("--disable-dev-shm-usage")
+        options.add_argument("--disable-gpu")
+        options.add_argument("--window-size=1920,1080")
+        # DESHABILITAR GEOLOCALIZACIÓN
+        options.add_argument("--disable-geolocation")
+        options.add_argument("--disable-features=VizDisplayCompositor")
+        user_data_dir = self.slot_dir(slot)
+        if user_data_dir and profile_in_use(user_data_dir):
+            # Otro proceso vivo de esta máquina (daemon + ejecución manual) tiene abierto el mismo slot
+            LOG.warning(f"⚠️ Perfil {os.path.basename(user_data_dir)} en uso por otro proceso, se usa uno temporal")
+            user_data_dir = None
+        if user_data_dir:
+            os.makedirs(user_data_dir, exist_ok=True)
+            # El candado es de un Chrome que ya no existe: si quedara, Chrome se negaría a abrir el perfil
+            for lock_name in ("SingletonLock", "SingletonSocket", "SingletonCookie"):
+                lock_path = os.path.join(user_data_dir, lock_name)
+                if os.path.lexists(lock_path):
+                    os.remove(lock_path)
+            options.add_argument(f"--user-data-dir={user_data_dir}")
+            options.add_argument(f"--disk-cache-size={self.disk_cache_mb * 1024 * 1024}")
+        prefs = {
+            "profile.default_content_setting_values.geolocation": 2,
+            "profile.default_content_settings.popups": 0,
+            "profile.managed_default_content_settings.geolocation": 2
+        }
+        options.add_experimental_option("prefs", prefs)
+        return options
+
+    def apply(self, driver: webdriver.Chrome) -> None:
+        """Ajustes que se hacen sobre la sesión ya abierta: bloqueo de URLs y geolocalización anulada"""
+        if self.blocked_patterns:
+            try:
+                driver.execute_cdp_cmd("Network.enable", {})
+                driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": self.blocked_patterns})
+            except Exception as e:
+                # Sin CDP la página carga igual, solo que completa
+                logging.warning(f"No se pudo activar el bloqueo de recursos: {str(e)}")
+
+        # JavaScript para anular geolocalización
+        driver.execute_script("""
+            navigator.geolocation.getCurrentPosition = function(success, error) {
+                if (error) error({ code: 1, message: 'User denied Geolocation' });
+            };
+            navigator.geolocation.watchPosition = function() { return null; };
+        """)
+
+
+class BrowserPool:
+    """Pool de sesiones de Chrome reutilizables entre RUTs.
+
+    Una sesión que terminó bien vuelve con su página de marcaje cargada, y al pedir una sesión
+    se prefiere la que ya tiene cargada la página del RUT.
+    """
+
+    def __init__(self, size: int, max_uses: int = BROWSER_MAX_USES,
+                 admission: Optional[AdmissionController] = None, profile: Optional[BrowserProfile] = None):
+        self.size = size
+        self.max_uses = max_uses
+        self.admission = admission
+        self.profile = profile or BrowserProfile()
+        # Cada sesión viva ocupa un slot, y con él su directorio de perfil en disco
+        self._free_slots = list(range(size - 1, -1, -1))
+        self._slot_of: Dict[int, Optional[int]] = {}
+        # Sesiones libres junto a la página de marcaje que dejaron cargada ("" si quedaron en blanco)
+        # y el momento en que volvieron al pool
+        self._idle: List[Tuple[str, float, webdriver.Chrome]] = []
+        self._slots = admission if admission is not None else threading.BoundedSemaphore(size)
+        self._uses: Dict[int, int] = {}
+        self._lock = threading.Lock()
+
+    def _launch(self) -> webdriver.Chrome:
+        from selenium import webdriver
+
+        with self._lock:
+            slot = self._free_slots.pop() if self._free_slots else None
+        try:
+            LOG.info("🌐 Iniciando navegador sin geolocalización...")
+            with PHASES.span("chrome_launch"):
+                driver = webdriver.Chrome(options=self.profile.options(slot))
+            self.profile.apply(driver)
+        except BaseException:
+            self._return_slot(slot)
+            raise
+
+        with self._lock:
+            self._uses[id(driver)] = 0
+            self._slot_of[id(driver)] = slot
+        return driver
+
+    def _return_slot(self, slot: Optional[int]) -> None:
+        if slot is not None:
+            with self._lock:
+                self._free_slots.append(slot)
+
+    def _is_healthy(self, driver: webdriver.Chrome) -> bool:
+        try:
+            driver.execute_script("return document.readyState")
+            return True
+        except Exception:
+            return False
+
+    def _discard(self, driver: webdriver.Chrome) -> None:
+        with self._lock:
+            self._uses.pop(id(driver), None)
+            slot = self._slot_of.pop(id(driver), None)
+        try:
+            driver.quit()
+        except Exception as e:
+            logging.warning(f"No se pudo cerrar navegador: {str(e)}")
+        # Recién con Chrome cerrado se libera el perfil para otra sesión
+        self._return_slot(slot)
+
+    def _take_idle(self, endpoint: str) -> Optional[Tuple[str, float, webdriver.Chrome]]:
+        """La sesión libre más reciente con esa página cargada; si no hay, una en blanco y luego cualquiera"""
+        with self._lock:
+            if not self._idle:
+                return None
+            for wanted in (endpoint, ""):
+                for i in range(len(self._idle) - 1, -1, -1):
+                    if self._idle[i][0] == wanted:
+                        return self._idle.pop(i)
+            return self._idle.pop()
+
+    def _blank(self, driver: webdriver.Chrome) -> bool:
+        """Deja la sesión sin estado del RUT anterior; la página se recarga al tomarla"""
+        try:
+            driver.delete_all_cookies()
+            driver.get("about:blank")
+            return True
+        except Exception:
+            self._discard(driver)
+            return False
+
+    def _checkout(self, endpoint: str) -> webdriver.Chrome:
+        while True:
+            entry = self._take_idle(endpoint)
+            if entry is None:
+                return self._launch()
+            loaded, idle_since, driver = entry
+            if not self._is_healthy(driver):
+                LOG.info("♻️ Sesión de navegador no responde, se descarta")
+                self._discard(driver)
+                continue
+            # Una página que esperó demasiado puede tener la sesión de ctrlit vencida: se recarga
+            if loaded and monotonic() - idle_since > BROWSER_PAGE_MAX_AGE and not self._blank(driver):
+                continue
+            return driver
+
+    def _release(self, driver: webdriver.Chrome, endpoint: str = "") -> None:
+        if self.admission is not None and self.admission.adaptive:
+            try:
+                self.admission.observe_session(tree_rss_kb(driver.service.process.pid) / 1024)
+            except Exception:
+                pass
+        with self._lock:
+            self._uses[id(driver)] = self._uses.get(id(driver), 0) + 1
+            uses = self._uses[id(driver)]
+        if uses >= self.max_uses:
+            LOG.info(f"♻️ Reciclando sesión de navegador tras {uses} usos")
+            self._discard(driver)
+            return
+        if not endpoint and not self._blank(driver):
+            return
+        # Con endpoint la página queda cargada: es un kiosco de marcaje pensado para RUTs seguidos
+        with self._lock:
+            self._idle.append((endpoint, monotonic(), driver))
+
+    def warm(self, count: int) -> None:
+        """Lanza sesiones por adelantado para que el primer RUT no pague el arranque de Chrome"""
+        with self._lock:
+            missing = min(count, self.size) - len(self._idle)
+        for _ in range(missing):
+            driver = self._launch()
+            with self._lock:
+                self._idle.append(("", monotonic(), driver))
+
+    def blank_idle(self) -> None:
+        """Deja en blanco las sesiones libres: una página cargada no se reutiliza de una ventana a otra"""
+        with self._lock:
+            loaded = [entry for entry in self._idle if entry[0]]
+            self._idle = [entry for entry in self._idle if not entry[0]]
+        for _, _, driver in loaded:
+            if self._blank(driver):
+                with self._lock:
+                    self._idle.append(("", monotonic(), driver))
+
+    @contextmanager
+    def session(self, endpoint: str = "") -> Iterator[webdriver.Chrome]:
+        """Entrega una sesión y garantiza que vuelva al pool o se cierre si algo falla.
+
+        Con endpoint se prefiere una sesión que ya tenga esa página cargada, y al terminar bien
+        la sesión vuelve al pool sin salir de ella.
+        """
+        with self._slots:
+            with PHASES.span("browser_checkout"):
+                driver = self._checkout(endpoint)
+            try:
+                yield driver
+            except BaseException:
+                self._discard(driver)
+                raise
+            self._release(driver, endpoint)
+
+    def shutdown(self) -> None:
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                *_, driver = self._idle.pop()
+            self._discard(driver)
+
+
+# Resuelve todos los objetivos de la página de marcaje en un solo round trip.
+# Solo considera elementos visibles, igual que WebElement.text.
+DIAL_LOCATOR_JS = """
+const action = arguments[0];
+const label = el => el.getClientRects().length ? (el.innerText || '').trim().toUpperCase() : '';
+const targets = {action: null, digits: {}, enviar: null};
+for (const el of document.querySelectorAll('button, div, span, li')) {
+    if (label(el) === action) { targets.action = el; break; }
+}
+for (const el of document.querySelectorAll('li.digits')) {
+    const text = label(el);
+    if (text && !(text in targets.digits)) targets.digits[text] = el;
+}
+for (const el of document.querySelectorAll('li.pad-action.digits')) {
+    if (label(el) === 'ENVIAR') { targets.enviar = el; break; }
+}
+return targets;
+"""
+
+
+def locate_dial_targets(driver: webdriver.Chrome, action_type: str) -> Dict:
+    """Devuelve botón de acción, mapa dígito→elemento y botón ENVIAR con una sola llamada a WebDriver"""
+    return driver.execute_script(DIAL_LOCATOR_JS, action_type)
+
+
+# Cambia cuando ENVIAR desaparece/se oculta o el texto de la página ya no es el de antes del click
+SUBMIT_SETTLED_JS = """
+const enviar = arguments[0];
+return !document.contains(enviar) || !enviar.getClientRects().length
+    || (document.body ? document.body.innerText : '') !== arguments[1];
+"""
+
+
+def wait_for(driver: webdriver.Chrome, condition, timeout: float):
+    """Espera hasta que la condición devuelva algo verdadero y lo retorna; lanza TimeoutException si no"""
+    from selenium.webdriver.support.ui import WebDriverWait
+    return WebDriverWait(driver, timeout, poll_frequency=WAIT_POLL_INTERVAL).until(condition)
+
+
+def keypad_ready(driver: webdriver.Chrome, action_type: str):
+    """Condición: el teclado de dígitos y el botón ENVIAR están visibles"""
+    targets = locate_dial_targets(driver, action_type)
+    if targets["digits"] and targets["enviar"]:
+        return targets
+    return None
+
+
+def submit_settled(enviar, before_text: str):
+    """Condición: la página reaccionó al click en ENVIAR"""
+    from selenium.common.exceptions import StaleElementReferenceException
+
+    def condition(driver: webdriver.Chrome) -> bool:
+        try:
+            return driver.execute_script(SUBMIT_SETTLED_JS, enviar, before_text)
+        except StaleElementReferenceException:
+            return True
+    return condition
+
+
+class HumanPacing:
+    """Pausas cortas con jitter entre teclas y antes de enviar, separadas de las esperas por condición"""
+
+    def __init__(self, keystroke: Tuple[float, float], submit: Tuple[float, float]):
+        self.keystroke_range = keystroke
+        self.submit_range = submit
+
+    @staticmethod
+    def _pause(bounds: Tuple[float, float]) -> None:
+        low, high = bounds
+        if high > 0:
+            sleep(random.uniform(low, high))
+
+    def keystroke(self) -> None:
+        self._pause(self.keystroke_range)
+
+    def before_submit(self) -> None:
+        self._pause(self.submit_range)
+
+
+def parse_range(value: str, default: Tuple[float, float]) -> Tuple[float, float]:
+    """Convierte "min,max" (o un solo número) en una tupla de segundos"""
+    if not value:
+        return default
+    try:
+        parts = [float(p) for p in value.split(",")]
+    except ValueError:
+        logging.warning(f"Rango inválido '{value}', usando {default}")
+        return default
+    return (parts[0], parts[-1])
+
+
+PACING = HumanPacing(
+    keystroke=parse_range(os.getenv('PACING_KEYSTROKE'), (0.05, 0.15)),
+    submit=parse_range(os.getenv('PACING_SUBMIT'), (0.2, 0.5)),
+)
+
+
+class PermanentMarkError(Exception):
+    """Fallo que no se arregla reintentando (RUT con caracteres inválidos, marcaje rechazado)"""
+
+
+class CircuitOpenError(Exception):
+    """ctrlit acumuló demasiados fallos seguidos en esta ejecución"""
+
+
+class SubmitUnconfirmedError(Exception):
+    """ENVIAR pudo llegar a ctrlit sin que se viera la respuesta: repetirlo podría marcar dos veces"""
+
+
+class CircuitBreaker:
+    """Corta los intentos contra ctrlit tras varios fallos seguidos y deja pasar una prueba tras el enfriamiento"""
+
+    def __init__(self, threshold: int, cooldown: float):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self.failures = 0
+            self.opened_at: Optional[float] = None
+
+    def check(self) -> None:
+        """Lanza CircuitOpenError mientras el circuito esté abierto"""
+        if self.threshold <= 0:
+            return
+        with self._lock:
+            if self.opened_at is None:
+                return
+            remaining = self.cooldown - (monotonic() - self.opened_at)
+            if remaining <= 0:
+                # Medio abierto: pasa este intento; si falla, failure() vuelve a abrir
+                self.opened_at = None
+                self.failures = self.threshold - 1
+                return
+        raise CircuitOpenError(f"ctrlit no responde, circuito abierto por {int(remaining)}s más")
+
+    def success(self) -> None:
+        with self._lock:
+            self.failures = 0
+
+    def failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self.threshold > 0 and self.failures >= self.threshold and self.opened_at is None:
+                self.opened_at = monotonic()
+                LOG.info(f"🔌 Circuito abierto: {self.failures} fallos seguidos contra ctrlit")
+                logging.error(f"Circuito abierto tras {self.failures} fallos seguidos contra ctrlit")
+
+
+def is_transient(error: Exception) -> bool:
+    return not isinstance(error, (PermanentMarkError, CircuitOpenError))
+
+
+class RetryPolicy:
+    """Reintentos de una fase con backoff exponencial acotado y jitter completo"""
+
+    def __init__(self, attempts: int, base: float, cap: float, breaker: CircuitBreaker):
+        self.attempts = attempts
+        self.base = base
+        self.cap = cap
+        self.breaker = breaker
+        self._local = threading.local()
+
+    def backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.cap, self.base * 2 ** (attempt - 1)))
+
+    def begin(self) -> None:
+        """Reinicia el contador de reintentos del hilo (uno por RUT)"""
+        self._local.retries = 0
+
+    def taken(self) -> int:
+        return getattr(self._local, "retries", 0)
+
+    def run(self, phase: str, action: Callable, recover: Optional[Callable[[], None]] = None,
+            retryable: Callable[[Exception], bool] = is_transient):
+        """Ejecuta `action`; antes de cada reintento corre `recover` para dejar la sesión lista de nuevo"""
+        current_thread = threading.current_thread()
+        with LOG_CONTEXT.phase_of(phase):
+            for attempt in range(1, self.attempts + 1):
+                self.breaker.check()
+                try:
+                    if attempt > 1 and recover is not None:
+                        recover()
+                    value = action()
+                except Exception as e:
+                    if isinstance(e, (PermanentMarkError, CircuitOpenError)):
+                        raise
+                    self.breaker.failure()
+                    if attempt == self.attempts or not retryable(e):
+                        raise
+                    self._local.retries = self.taken() + 1
+                    delay = self.backoff(attempt)
+                    LOG.info(
+                        f"🔁 [Hilo {current_thread.name}] Fase {phase} falló ({type(e).__name__}), "
+                        f"reintento {attempt}/{self.attempts - 1} en {delay:.1f}s")
+                    logging.warning(f"Fase {phase} falló en intento {attempt}: {str(e)}")
+                    sleep(delay)
+                    continue
+                self.breaker.success()
+                return value
+
+
+BREAKER = CircuitBreaker(CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_COOLDOWN_SECONDS)
+RETRY_POLICY = RetryPolicy(RETRY_ATTEMPTS, RETRY_BASE_SECONDS, RETRY_MAX_SECONDS, BREAKER)
+
+
+class HttpSessionPool:
+    """Pool de requests.Session con conexiones keep-alive para el motor HTTP"""
+
+    def __init__(self, size: int):
+        self._idle: "queue.LifoQueue[requests.Session]" = queue.LifoQueue()
+        self._size = size
+
+    def _new_session(self) -> requests.Session:
+        requests = load_requests()
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self._size)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        session.headers.update({"User-Agent": HTTP_USER_AGENT})
+        return session
+
+    @contextmanager
+    def session(self) -> Iterator[requests.Session]:
+        """Entrega una sesión sin cookies de marcajes anteriores; se cierra si algo falla"""
+        try:
+            session = self._idle.get_nowait()
+        except queue.Empty:
+            session = self._new_session()
+        try:
+            yield session
+        except BaseException:
+            session.close()
+            raise
+        session.cookies.clear()
+        self._idle.put(session)
+
+    def shutdown(self) -> None:
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+BROWSER_POOL = None
+BROWSER_POOL_LOCK = threading.Lock()
+HTTP_POOL = None
+
+
+def get_http_pool() -> HttpSessionPool:
+    """Crea el pool de sesiones HTTP la primera vez que se necesita"""
+    global HTTP_POOL
+    with BROWSER_POOL_LOCK:
+        if HTTP_POOL is None:
+            HTTP_POOL = HttpSessionPool(MAX_BROWSERS)
+        return HTTP_POOL
+
+
+def get_browser_pool() -> BrowserPool:
+    """Crea el pool de navegadores la primera vez que se necesita"""
+    global BROWSER_POOL
+    with BROWSER_POOL_LOCK:
+        if BROWSER_POOL is None:
+            BROWSER_POOL = BrowserPool(MAX_BROWSERS, admission=ADMISSION)
+        return BROWSER_POOL
+
+
+# Página de marcaje de cada RUT según el valor de su flag (se llena al leer los flags)
+DIAL_ENDPOINTS: Dict[str, str] = {}
+DIAL_ENDPOINTS_LOCK = threading.Lock()
+DIAL_ENDPOINTS_FROM_FILE: Optional[Dict[str, str]] = None
+
+
+def endpoint_url(value: str) -> str:
+    """URL del dial a partir de una URL completa o de un código de sitio de ctrlit"""
+    value = value.strip().rstrip("/")
+    if value.startswith(("http://", "https://")):
+        return value
+    return f"{DIAL_URL.rsplit('/', 1)[0]}/{value}"
+
+
+def load_dial_endpoints_file() -> Dict[str, str]:
+    """Lee una vez DIAL_ENDPOINTS_FILE; si falta o está mal formado se usa DIAL_URL"""
+    global DIAL_ENDPOINTS_FROM_FILE
+    with DIAL_ENDPOINTS_LOCK:
+        if DIAL_ENDPOINTS_FROM_FILE is None:
+            mapping: Dict[str, str] = {}
+            if DIAL_ENDPOINTS_FILE:
+                try:
+                    with open(DIAL_ENDPOINTS_FILE, encoding="utf-8") as f:
+                        data = json.load(f)
+                    mapping = {rut.lower(): endpoint_url(value) for rut, value in data.items()
+                               if isinstance(value, str) and value.strip()}
+                except (OSError, ValueError, AttributeError) as e:
+                    LOG.warning(f"⚠️ No se pudo leer {DIAL_ENDPOINTS_FILE}: {str(e)}")
+                    logging.warning(f"No se pudo leer el archivo de endpoints: {str(e)}")
+            DIAL_ENDPOINTS_FROM_FILE = mapping
+        return DIAL_ENDPOINTS_FROM_FILE
+
+
+def set_flag_endpoint(rut: str, value) -> None:
+    """Guarda la página de marcaje que trae el flag de un RUT; un flag booleano usa la por defecto"""
+    with DIAL_ENDPOINTS_LOCK:
+        if isinstance(value, str) and value.strip():
+            DIAL_ENDPOINTS[rut.lower()] = endpoint_url(value)
+        else:
+            DIAL_ENDPOINTS.pop(rut.lower(), None)
+
+
+def dial_url_for(rut: str) -> str:
+    """Página de marcaje de un RUT: la de su flag, la de DIAL_ENDPOINTS_FILE o DIAL_URL"""
+    with DIAL_ENDPOINTS_LOCK:
+        url = DIAL_ENDPOINTS.get(rut.lower())
+    return url or load_dial_endpoints_file().get(rut.lower()) or DIAL_URL
+
+
+def submit_url_for(dial_url: str) -> str:
+    return HTTP_SUBMIT_URL or f"{dial_url}/mark"
+
+
+def open_dial(driver: webdriver.Chrome, dial_url: str) -> None:
+    started = perf_counter()
+    with PHASES.span("page_load"):
+        driver.get(dial_url)
+    ADMISSION.observe_latency(perf_counter() - started)
+
+
+def reset_dial(driver: webdriver.Chrome, dial_url: str, action_type: str) -> bool:
+    """Deja lista para otro RUT una página de marcaje que la sesión ya tiene cargada, sin navegar.
+
+    Tras ENVIAR la página vuelve sola a la pantalla inicial y el teclado se limpia al elegir
+    la acción; si la sesión está en otra página o no vuelve a tiempo, hay que recargar.
+    """
+    from selenium.common.exceptions import TimeoutException
+    try:
+        if driver.current_url.rstrip("/") != dial_url.rstrip("/"):
+            return False
+        with PHASES.span("dial_reset"):
+            wait_for(driver, lambda d: locate_dial_targets(d, action_type)["action"], WAIT_RESET_TIMEOUT)
+        return True
+    except TimeoutException:
+        return False
+    except Exception as e:
+        logging.warning(f"No se pudo reutilizar la página de marcaje: {str(e)}")
+        return False
+
+
+# Texto del RUT que muestra el teclado; null si la página no tiene ese elemento
+DIAL_ECHO_JS = """
+const echo = document.querySelector(arguments[0]);
+if (!echo) return null;
+return ('value' in echo ? echo.value : echo.innerText || '').trim();
+"""
+
+
+def keypad_clear(driver: webdriver.Chrome, action_type: str) -> bool:
+    """True si el teclado quedó visible y sin dígitos del RUT anterior"""
+    from selenium.common.exceptions import TimeoutException
+    try:
+        with PHASES.span("keypad_check"):
+            wait_for(driver, lambda d: keypad_ready(d, action_type), WAIT_RESET_TIMEOUT)
+            return driver.execute_script(DIAL_ECHO_JS, DIAL_ECHO_SELECTOR) == ""
+    except TimeoutException:
+        return False
+    except Exception as e:
+        logging.warning(f"No se pudo revisar el teclado de marcaje: {str(e)}")
+        return False
+
+
+def choose_action(driver: webdriver.Chrome, action_type: str) -> None:
+    from selenium.common.exceptions import TimeoutException
+    try:
+        with PHASES.span("find_action"):
+            boton = wait_for(driver, lambda d: locate_dial_targets(d, action_type)["action"],
+                             WAIT_PAGE_TIMEOUT)
+    except TimeoutException:
+        raise Exception(f"No se encontró botón {action_type}")
+    with PHASES.span("action_click"):
+        boton.click()
+
+
+def enter_rut(driver: webdriver.Chrome, rut: str, action_type: str) -> Dict:
+    """Tipea el RUT en el teclado y devuelve los elementos del teclado para enviar"""
+    from selenium.common.exceptions import TimeoutException
+    current_thread = threading.current_thread()
+    # El teclado aparece después del click, así que se resuelve de nuevo
+    try:
+        with PHASES.span("keypad_wait"):
+            targets = wait_for(driver, lambda d: keypad_ready(d, action_type), WAIT_KEYPAD_TIMEOUT)
+    except TimeoutException:
+        raise Exception("El teclado de marcaje no apareció a tiempo")
+    buttons = targets["digits"]
+    if LOG_VERBOSE:
+        LOG.debug(f"📱 [Hilo {current_thread.name}] Botones disponibles: {list(buttons)}")
+
+    with PHASES.span("digit_entry"):
+        for i, char in enumerate(rut):
+            if LOG_VERBOSE:
+                LOG.debug(f"🔤 [Hilo {current_thread.name}] Ingresando carácter {i+1}/{len(rut)}")
+            el = buttons.get(char.upper())
+            if el is None:
+                raise PermanentMarkError(f"No se encontró el carácter: {char}")
+            el.click()
+            PACING.keystroke()
+
+        PACING.before_submit()
+    return targets
+
+
+def press_submit(driver: webdriver.Chrome, targets: Dict, rut: str) -> None:
+    from selenium.common.exceptions import TimeoutException
+    current_thread = threading.current_thread()
+    with PHASES.span("submit"):
+        enviar = targets["enviar"]
+        before_text = driver.execute_script("return document.body ? document.body.innerText : ''")
+        enviar.click()
+        # Desde aquí el click ya salió: ningún error se reintenta para no marcar dos veces
+        try:
+            wait_for(driver, submit_settled(enviar, before_text), WAIT_SUBMIT_TIMEOUT)
+        except TimeoutException:
+            logging.warning(
+                f"No se observó confirmación tras ENVIAR para RUT {rut[:4]}**** en {WAIT_SUBMIT_TIMEOUT}s")
+            LOG.warning(
+                f"⚠️ [Hilo {current_thread.name}] Sin confirmación visible tras ENVIAR, se asume enviado")
+        except Exception as e:
+            # La página navegó o la ventana se cerró tras el click: también se asume enviado
+            logging.warning(
+                f"Error esperando confirmación tras ENVIAR para RUT {rut[:4]}****: {str(e)}")
+            LOG.warning(
+                f"⚠️ [Hilo {current_thread.name}] Error tras ENVIAR ({type(e).__name__}), se asume enviado")
+
+
+def mark_with_selenium(rut: str, action_type: str) -> None:
+    """Marca en la página de ctrlit usando una sesión de Chrome del pool.
+
+    Cada fase se reintenta en la misma sesión; antes de ENVIAR la página no guarda estado,
+    así que retomar es recargar el dial y rehacer los pasos previos.
+    """
     current_thread = threading.current_thread()
+    dial_url = dial_url_for(rut)
+    LOG.info(
+        f"🌐 [Hilo {current_thread.name}] Tomando sesión de navegador del pool...")
+    # La sesión vuelve al pool al terminar o se descarta si algún paso falla
+    with get_browser_pool().session(dial_url) as driver, SERVICE_CLOCK.measure():
+        def restart_form() -> None:
+            open_dial(driver, dial_url)
+            choose_action(driver, action_type)
+
+        reused = reset_dial(driver, dial_url, action_type)
+        if reused:
+            LOG.info(
+                f"♻️ [Hilo {current_thread.name}] Reutilizando página de marcaje ya cargada")
+        else:
+            LOG.info(
+                f"🌐 [Hilo {current_thread.name}] Cargando página de marcaje...")
+            RETRY_POLICY.run("page_load", lambda: open_dial(driver, dial_url))
+
+        LOG.info(
+            f"👆 [Hilo {current_thread.name}] Click en botón {action_type}")
+        RETRY_POLICY.run("action_click", lambda: choose_action(driver, action_type),
+                         recover=lambda: open_dial(driver, dial_url))
+
+        # En una página reutilizada el RUT anterior no debe seguir en el teclado; si no se puede
+        # confirmar que está vacío, se recarga la página completa
+        if reused and not keypad_clear(driver, action_type):
+            LOG.info(
+                f"🌐 [Hilo {current_thread.name}] Teclado sin confirmar vacío, recargando página de marcaje...")
+            RETRY_POLICY.run("page_load", restart_form)
 
-    # Capturar logs para el email
-    log_messages = []
+        LOG.info(
+            f"🔢 [Hilo {current_thread.name}] Ingresando RUT: {rut[:4]}****")
+        form = {"targets": RETRY_POLICY.run("digit_entry", lambda: enter_rut(driver, rut, action_type),
+                                            recover=restart_form)}
+
+        def retype() -> None:
+            restart_form()
+            form["targets"] = enter_rut(driver, rut, action_type)
+
+        LOG.info(f"📤 [Hilo {current_thread.name}] Enviando formulario...")
+        RETRY_POLICY.run("submit", lambda: press_submit(driver, form["targets"], rut), recover=retype)
+
+    LOG.info(f"🌐 [Hilo {current_thread.name}] Sesión de navegador liberada")
+
+
+def http_submit_retryable(error: Exception) -> bool:
+    """Solo se reintenta el POST si es seguro que ctrlit no lo procesó"""
+    requests = load_requests()
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    if isinstance(error, requests.exceptions.Timeout):
+        return False
+    if isinstance(error, requests.exceptions.HTTPError) and error.response is not None:
+        return error.response.status_code in (502, 503, 504)
+    return isinstance(error, requests.exceptions.ConnectionError)
+
+
+def json_status(response: requests.Response) -> Tuple[Optional[str], Optional[str]]:
+    """(status, message) de una respuesta JSON de ctrlit; (None, None) si no es JSON o no trae status"""
+    if "json" not in response.headers.get("Content-Type", ""):
+        return None, None
+    try:
+        result = response.json()
+    except ValueError:
+        return None, None
+    if not isinstance(result, dict) or result.get("status") is None:
+        return None, None
+    return str(result["status"]), result.get("message")
+
+
+def mark_with_http(rut: str, action_type: str) -> None:
+    """Reproduce por HTTP lo que hace la página de marcaje: cargar el dial, elegir acción, RUT y ENVIAR"""
+    current_thread = threading.current_thread()
+    dial_url = dial_url_for(rut)
+    with get_http_pool().session() as session, SERVICE_CLOCK.measure():
+        LOG.info(
+            f"🌐 [Hilo {current_thread.name}] Cargando página de marcaje (HTTP)...")
+        def load_page() -> requests.Response:
+            with PHASES.span("http_page_load"):
+                response = session.get(dial_url, timeout=HTTP_TIMEOUT)
+                response.raise_for_status()
+                return response
+
+        response = RETRY_POLICY.run("http_page_load", load_page)
+
+        payload = {"action": action_type, "rut": rut.upper()}
+        token = CSRF_TOKEN_RE.search(response.text)
+        if token:
+            payload["_token"] = token.group(1)
+
+        LOG.info(f"📤 [Hilo {current_thread.name}] Enviando marcaje (HTTP)...")
+        def post_mark() -> requests.Response:
+            with PHASES.span("http_submit"):
+                response = session.post(submit_url_for(dial_url), data=payload, timeout=HTTP_TIMEOUT)
+                response.raise_for_status()
+                return response
+
+        try:
+            response = RETRY_POLICY.run("http_submit", post_mark, retryable=http_submit_retryable)
+        except (PermanentMarkError, CircuitOpenError):
+            raise
+        except Exception as e:
+            if http_submit_retryable(e):
+                raise
+            rejected = getattr(e, "response", None)
+            if rejected is not None and 400 <= rejected.status_code < 500:
+                # ctrlit no procesó el POST: con motivo en JSON es un rechazo, sin él se prueba con el navegador
+                status, message = json_status(rejected)
+                if status is not None:
+                    raise PermanentMarkError(f"Marcaje rechazado: {message or status}") from e
+                raise
+            raise SubmitUnconfirmedError(
+                f"ENVIAR por HTTP sin confirmación ({type(e).__name__}): {str(e)}") from e
+
+        # El POST llegó y ctrlit respondió 2xx: solo una confirmación explícita cuenta como marcaje,
+        # pero sin ella tampoco se repite con el navegador (podría quedar marcado dos veces)
+        status, message = json_status(response)
+        if status in ("success", "ok"):
+            return
+        if status is not None:
+            raise PermanentMarkError(f"Marcaje rechazado: {message or status}")
+        if HTTP_SUCCESS_MARKER and HTTP_SUCCESS_MARKER in response.text:
+            return
+        raise SubmitUnconfirmedError(f"ctrlit respondió {response.status_code} sin confirmar el marcaje")
+
+
+def submit_mark(rut: str, action_type: str) -> int:
+    """Ejecuta el marcaje con el motor configurado, usando Selenium como respaldo del motor HTTP.
+
+    Devuelve cuántos reintentos hicieron falta.
+    """
+    current_thread = threading.current_thread()
+    RETRY_POLICY.begin()
+    if SUBMIT_ENGINE == "http":
+        try:
+            mark_with_http(rut, action_type)
+            LOG.info(f"📤 [Hilo {current_thread.name}] Marcaje enviado por HTTP")
+            return RETRY_POLICY.taken()
+        except Exception as e:
+            # El navegador solo entra si es seguro que el POST del motor HTTP no llegó a ctrlit
+            if not SUBMIT_FALLBACK or isinstance(e, (PermanentMarkError, CircuitOpenError,
+                                                     SubmitUnconfirmedError)):
+                raise
+            LOG.warning(
+                f"⚠️ Motor HTTP falló para RUT {rut[:4]}****: {str(e)}. Reintentando con Selenium...")
+            logging.warning(
+                f"Motor HTTP falló para RUT {rut[:4]}****, usando Selenium: {str(e)}")
+    mark_with_selenium(rut, action_type)
+    LOG.info(f"📤 [Hilo {current_thread.name}] Marcaje enviado por navegador")
+    return RETRY_POLICY.taken() + (1 if SUBMIT_ENGINE == "http" else 0)
+
+
+def action_for(chile_time: datetime) -> str:
+    """ENTRADA en la mañana, SALIDA el resto del día (hora de Chile)"""
+    return "ENTRADA" if 5 <= chile_time.hour < 12 else "SALIDA"
+
+
+def mark_rut(rut: str) -> Dict:
+    """Marca un RUT y devuelve su resultado junto al correo que lo notifica, sin enviarlo"""
+    from email.message import EmailMessage
+    current_thread = threading.current_thread()
+    PHASES.bind(rut)
+    # Desde aquí los mensajes de este hilo quedan etiquetados con el RUT y en su buffer para el correo
+    LOG_CONTEXT.bind(rut)
+    RUT_LOGS.start(rut)
+    SERVICE_CLOCK.reset()
+
+    result = {"rut": rut, "action": None, "status": "ok", "error": None, "retries": 0}
 
     # Get Chile time at the start of processing this RUT
     chile_tz = pytz.timezone('America/Santiago')
     start_time = datetime.now(chile_tz)
+    result["started_at"] = start_time.isoformat()
 
     try:
-        log_messages.append(f"🚀 Iniciando procesamiento RUT: {rut[:4]}**** a las {start_time.strftime('%H:%M:%S')} (CLT)")
-        print(f"🚀 [Hilo {current_thread.name}] Iniciando RUT {rut[:4]}**** a las {start_time.strftime('%H:%M:%S')} (CLT)")
-
-        # DELAY ALEATORIO POR CADA RUT (solo en modo producción)
-        if not DEBUG_MODE:
-            delay_minutes = get_random_delay(rut)
-            print(
-                f"⏰ [Hilo {current_thread.name}] Aplicando delay aleatorio para RUT {rut[:4]}****: {delay_minutes} minutos")
-            print(
-                f"⏳ [Hilo {current_thread.name}] Esperando para simular comportamiento humano...")
-            logging.info(
-                f"Aplicando delay de {delay_minutes} minutos para RUT {rut[:4]}****")
-            sleep(delay_minutes * 60)  # Convertir minutos a segundos
-            print(
-                f"✅ [Hilo {current_thread.name}] Delay completado para RUT {rut[:4]}****, continuando...")
-        else:
-            print(
-                f"🔄 [Hilo {current_thread.name}] Modo DEBUG activo: sin delay para RUT {rut[:4]}****")
+        LOG.info(f"🚀 [Hilo {current_thread.name}] Iniciando RUT {rut[:4]}**** a las {start_time.strftime('%H:%M:%S')} (CLT)")
 
         # Get Chile time using pytz to handle DST (Daylight Saving Time) changes automatically
         chile_tz = pytz.timezone('America/Santiago')
         chile_time = datetime.now(chile_tz)
 
-        print(
+        LOG.info(
             f"🕐 [Hilo {current_thread.name}] Hora Chile: {chile_time.strftime('%H:%M:%S')} (CLT)")
-        print(f"📍 [Hilo {current_thread.name}] Ubicación: Sin coordenadas")
+        LOG.info(f"📍 [Hilo {current_thread.name}] Ubicación: Sin coordenadas")
 
         # Determine action type
-        action_type = "ENTRADA" if 5 <= chile_time.hour < 12 else "SALIDA"
-        print(f"🔍 [Hilo {current_thread.name}] Tipo de marcaje: {action_type}")
+        action_type = action_for(chile_time)
+        result["action"] = action_type
+        LOG.info(f"🔍 [Hilo {current_thread.name}] Tipo de marcaje: {action_type}")
 
         if DEBUG_MODE:
-            log_messages.append("🧪 Modo DEBUG activo - simulando marcaje")
+            LOG.info(f"🧪 [Hilo {current_thread.name}] Modo DEBUG activo - simulando marcaje")
             mensaje = f"🧪 DEBUG activo: no se ejecutó marcaje. Hora Chile: {chile_time.strftime('%H:%M:%S')} (CLT)"
         else:
-            log_messages.append("⚡ Iniciando marcaje real...")
-            print(f"⚡ [Hilo {current_thread.name}] Iniciando marcaje real...")
-
-            # Configure Chrome options - DESHABILITAR GEOLOCALIZACIÓN
-            options = Options()
-            options.add_argument("--headless")
-            options.add_argument("--no-sandbox")
-            options.add_argument("--disable-dev-shm-usage")
-            options.add_argument("--disable-gpu")
-            options.add_argument("--window-size=1920,1080")
-            # DESHABILITAR GEOLOCALIZACIÓN
-            options.add_argument("--disable-geolocation")
-            options.add_argument("--disable-features=VizDisplayCompositor")
-            prefs = {
-                "profile.default_content_setting_values.geolocation": 2,
-                "profile.default_content_settings.popups": 0,
-                "profile.managed_default_content_settings.geolocation": 2
-            }
-            options.add_experimental_option("prefs", prefs)
-
-            print(
-                f"🌐 [Hilo {current_thread.name}] Iniciando navegador sin geolocalización...")
-            driver = webdriver.Chrome(options=options)
-
-            # JavaScript para anular geolocalización
-            driver.execute_script("""
-                navigator.geolocation.getCurrentPosition = function(success, error) {
-                    if (error) error({ code: 1, message: 'User denied Geolocation' });
-                };
-                navigator.geolocation.watchPosition = function() { return null; };
-            """)
-
-            print(
-                f"🌐 [Hilo {current_thread.name}] Cargando página de marcaje...")
-            driver.get("https://app.ctrlit.cl/ctrl/dial/web/K1NBpBqyjf")
-            driver.implicitly_wait(10)
-            sleep(2)
-
-            print(
-                f"🔘 [Hilo {current_thread.name}] Buscando botón {action_type}...")
-            boton = next((el for el in driver.find_elements(By.CSS_SELECTOR, 'button, div, span, li')
-                         if el.text.strip().upper() == action_type), None)
-            if not boton:
-                raise Exception(f"No se encontró botón {action_type}")
-
-            print(
-                f"👆 [Hilo {current_thread.name}] Click en botón {action_type}")
-            boton.click()
-            sleep(2)
-
-            print(
-                f"🔢 [Hilo {current_thread.name}] Ingresando RUT: {rut[:4]}****")
-            buttons = driver.find_elements(By.CSS_SELECTOR, "li.digits")
-            available_buttons = [el.text.strip() for el in buttons]
-            print(
-                f"📱 [Hilo {current_thread.name}] Botones disponibles: {available_buttons}")
-
-            for i, char in enumerate(rut):
-                print(
-                    f"🔤 [Hilo {current_thread.name}] Ingresando carácter {i+1}/{len(rut)}")
-                found = False
-                for el in buttons:
-                    if el.text.strip().upper() == char.upper():
-                        el.click()
-                        found = True
-                        break
-                if not found:
-                    raise Exception(f"No se encontró el carácter: {char}")
-                sleep(0.3)
-
-            sleep(1)
-
-            print(f"📤 [Hilo {current_thread.name}] Enviando formulario...")
-            enviar = next((el for el in driver.find_elements(By.CSS_SELECTOR, 'li.pad-action.digits')
-                          if el.text.strip().upper() == "ENVIAR"), None)
-            if not enviar:
-                raise Exception("No se encontró botón ENVIAR")
-            enviar.click()
-            sleep(1)
+            LOG.info(f"⚡ [Hilo {current_thread.name}] Iniciando marcaje real...")
 
-            driver.quit()
-            print(f"🌐 [Hilo {current_thread.name}] Navegador cerrado")
+            result["retries"] = submit_mark(rut, action_type)
+            get_mark_journal().record(rut, chile_time.date().isoformat(), action_type)
+            if result["retries"]:
+                LOG.info(f"🔁 [Hilo {current_thread.name}] Marcaje completado tras {result['retries']} reintento(s)")
 
             # Crear mensaje con logs incluidos
-            log_summary = "\n".join(log_messages[-10:])  # Últimos 10 logs
+            log_summary = "\n".join(RUT_LOGS.lines(rut)[-10:])  # Últimos 10 logs
             mensaje = f"""✅ {action_type} realizada con éxito a las {chile_time.strftime('%H:%M:%S')} (Chile - CLT).
 📍 Geolocalización: Sin coordenadas
 📍 Ubicación: Sin dirección
@@ -362,217 +1881,1241 @@ def process_rut(rut: str) -> None:
 📋 LOGS DEL PROCESO:
 {log_summary}"""
 
-        print(
+        LOG.info(
             f"✅ [Hilo {current_thread.name}] Marcaje completado para RUT: {rut[:4]}****")
 
-        # Enviar correo de confirmación
-        print(
-            f"📧 [Hilo {current_thread.name}] Enviando correo de confirmación...")
         email = EmailMessage()
         email["From"] = EMAIL_FROM
         email["To"] = EMAIL_TO
         email["Subject"] = f"{action_type} {'(simulada)' if DEBUG_MODE else ''} completada - RUT: {rut[:4]}****"
         email.set_content(mensaje)
 
-        with smtplib.SMTP(SMTP_SERVER, SMTP_PORT) as smtp:
-            smtp.starttls()
-            smtp.login(EMAIL_FROM, EMAIL_PASS)
-            smtp.send_message(email)
-        print(f"✅ [Hilo {current_thread.name}] Correo enviado exitosamente")
-
     except Exception as e:
         error_msg = f"""❌ Error en marcaje para RUT {rut[:4]}****:
 {str(e)}
 
 📋 LOGS DEL PROCESO:
-{chr(10).join(log_messages)}"""
-        print(error_msg)
-        logging.error(error_msg)
+{chr(10).join(RUT_LOGS.lines(rut))}"""
+        LOG.error(f"❌ [Hilo {current_thread.name}] Error en marcaje para RUT {rut[:4]}****: {str(e)}")
+        result["status"] = "error"
+        result["error"] = str(e)
 
-        # Enviar correo de error
-        print(f"📧 [Hilo {current_thread.name}] Enviando correo de error...")
         email = EmailMessage()
         email["From"] = EMAIL_FROM
         email["To"] = EMAIL_TO
-        email["Subject"] = f"Error en {action_type if 'action_type' in locals() else 'MARCAJE'} - RUT: {rut[:4]}****"
+        email["Subject"] = f"Error en {result['action'] or 'MARCAJE'} - RUT: {rut[:4]}****"
         email.set_content(error_msg)
 
-        try:
-            with smtplib.SMTP(SMTP_SERVER, SMTP_PORT) as smtp:
-                smtp.starttls()
-                smtp.login(EMAIL_FROM, EMAIL_PASS)
-                smtp.send_message(email)
-            print(f"✅ [Hilo {current_thread.name}] Correo de error enviado")
-        except Exception as mail_error:
-            print(
-                f"❌ [Hilo {current_thread.name}] No se pudo enviar correo de error: {str(mail_error)}")
-
     finally:
         # Log end time and calculate duration
         end_time = datetime.now(chile_tz)
         duration = (end_time - start_time).total_seconds()
         minutes, seconds = divmod(duration, 60)
-        
-        print(
+        result["duration"] = duration
+        result["service_time"] = SERVICE_CLOCK.seconds()
+        PHASES.record("mark_rut", start_time.timestamp(), duration, result["status"] == "ok")
+        result["phases"] = PHASES.phases_for(rut)
+
+        LOG.info(
             f"🏁 [Hilo {current_thread.name}] Proceso finalizado para RUT: {rut[:4]}**** a las {end_time.strftime('%H:%M:%S')} (CLT)")
-        print(
+        LOG.info(
             f"⏱️ [Hilo {current_thread.name}] Duración total: {int(minutes)} minutos y {int(seconds)} segundos")
+        LOG_CONTEXT.bind("")
+
+    result["email"] = email
+    return result
+
+
+def notify_result(result: Dict) -> None:
+    """Deja en el outbox el correo de confirmación o de error de un RUT ya procesado"""
+    current_thread = threading.current_thread()
+    kind = "confirmación" if result["status"] == "ok" else "error"
+    get_outbox().send(result["email"], digest=True, key=result["rut"])
+    LOG.info(f"📧 [Hilo {current_thread.name}] Correo de {kind} encolado")
+
+
+def process_rut(rut: str) -> Dict:
+    """Marca un RUT y notifica el resultado por correo"""
+    result = mark_rut(rut)
+    notify_result(result)
+    return result
+
+
+class MarkJournal:
+    """Diario append-only de marcajes exitosos (RUT, fecha, acción), con índice en memoria.
+
+    Cada entrada se escribe con fsync antes de seguir, así un corte a mitad de la ejecución
+    no pierde lo ya marcado. Al abrirlo se compacta: solo se conservan los últimos días,
+    por lo que el archivo y la carga no crecen con los meses.
+    """
+
+    def __init__(self, path: str, retention_days: int):
+        self.path = path
+        self.retention_days = retention_days
+        self._done = set()
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self) -> None:
+        cutoff = (date.today() - timedelta(days=self.retention_days)).isoformat()
+        kept, dropped = [], 0
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Línea a medio escribir por un corte: se descarta al compactar
+                        dropped += 1
+                        continue
+                    if entry["day"] < cutoff:
+                        dropped += 1
+                        continue
+                    kept.append(entry)
+                    self._done.add((entry["rut"], entry["day"], entry["action"]))
+        except OSError:
+            return
+        if dropped:
+            self._compact(kept)
+
+    def _compact(self, entries: List[Dict]) -> None:
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for entry in entries:
+                f.write(json.dumps(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def is_done(self, rut: str, day: str, action: str) -> bool:
+        return (rut, day, action) in self._done
+
+    def record(self, rut: str, day: str, action: str) -> None:
+        """Agrega un marcaje exitoso y lo baja a disco antes de volver"""
+        entry = {"rut": rut, "day": day, "action": action, "at": round(time(), 3)}
+        with self._lock:
+            if (rut, day, action) in self._done:
+                return
+            self._done.add((rut, day, action))
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(entry) + "\n")
+                    f.flush()
+                    os.fsync(f.fileno())
+            except OSError as e:
+                # El marcaje ya se hizo; perder la entrada solo arriesga repetirlo en una re-ejecución
+                logging.error(f"No se pudo registrar en el diario de marcajes: {str(e)}")
+
+
+class NullJournal:
+    """Diario deshabilitado (MARK_JOURNAL=false): nada cuenta como ya marcado"""
+
+    def is_done(self, rut: str, day: str, action: str) -> bool:
+        return False
+
+    def record(self, rut: str, day: str, action: str) -> None:
+        pass
+
+
+MARK_JOURNAL_STORE = None
+
+
+def get_mark_journal():
+    global MARK_JOURNAL_STORE
+    if MARK_JOURNAL_STORE is None:
+        MARK_JOURNAL_STORE = (MarkJournal(MARK_JOURNAL_FILE, MARK_JOURNAL_RETENTION_DAYS)
+                              if MARK_JOURNAL else NullJournal())
+    return MARK_JOURNAL_STORE
+
+
+def skip_completed(ruts: List[str]) -> List[str]:
+    """Quita los RUTs que ya tienen registrado el marcaje de esta ventana (fecha y acción)"""
+    chile_time = datetime.now(pytz.timezone('America/Santiago'))
+    day, action = chile_time.date().isoformat(), action_for(chile_time)
+    journal = get_mark_journal()
+    pending = [rut for rut in ruts if not journal.is_done(rut, day, action)]
+    if len(pending) < len(ruts):
+        LOG.info(f"📓 {len(ruts) - len(pending)} RUT(s) ya tienen {action} registrada hoy, se omiten")
+        logging.info(f"Diario de marcajes: se omiten {len(ruts) - len(pending)} RUT(s) con {action} del {day}")
+    return pending
+
+
+def shard_of(rut: str, shard_count: int) -> int:
+    """Shard estable de un RUT: no depende del orden ni de los demás flags"""
+    digest = hashlib.sha256(rut.lower().encode()).hexdigest()
+    return int(digest[:16], 16) % shard_count
+
+
+def in_shard(rut: str) -> bool:
+    return SHARD_COUNT <= 1 or shard_of(rut, SHARD_COUNT) == SHARD_INDEX
+
+
+def result_record(result: Dict) -> Dict:
+    """Resultado de un RUT sin el correo, listo para serializar"""
+    return {k: v for k, v in result.items() if k != "email"}
+
+
+def shard_results_path(shard_index: int) -> str:
+    return os.path.join(
+        logs_dir, f"shard-results-{RUN_ID}-{current_date}-{shard_index}-of-{SHARD_COUNT}.json")
+
+
+def write_shard_results(results: List[Dict], started_at: datetime) -> None:
+    """Guarda los resultados de este shard para que el coordinador los junte"""
+    path = shard_results_path(SHARD_INDEX)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({
+            "shard_index": SHARD_INDEX,
+            "shard_count": SHARD_COUNT,
+            "started_at": started_at.isoformat(),
+            "finished_at": datetime.now(started_at.tzinfo).isoformat(),
+            "results": [result_record(r) for r in results],
+        }, f, ensure_ascii=False, indent=2)
+    LOG.info(f"🧩 Resultados del shard guardados en: {path}")
+
+
+def merge_shard_results() -> Dict:
+    """Paso coordinador: junta los resultados de todos los shards en un solo resumen de la ejecución"""
+    summary = {"shard_count": SHARD_COUNT, "missing_shards": [], "results": []}
+    seen = set()
+    for index in range(SHARD_COUNT):
+        try:
+            with open(shard_results_path(index), encoding="utf-8") as f:
+                shard = json.load(f)
+        except (OSError, ValueError):
+            summary["missing_shards"].append(index)
+            continue
+        for record in shard["results"]:
+            if record["rut"] in seen:
+                logging.warning(f"RUT {record['rut'][:4]}**** aparece en más de un shard")
+                continue
+            seen.add(record["rut"])
+            summary["results"].append(dict(record, shard=index))
+
+    summary["total"] = len(summary["results"])
+    summary["failed"] = sum(1 for r in summary["results"] if r["status"] != "ok")
+    path = os.path.join(logs_dir, f"run-summary-{RUN_ID}-{current_date}.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(summary, f, ensure_ascii=False, indent=2)
+
+    LOG.info("=" * 40)
+    LOG.info(f"🧩 RESUMEN DE {SHARD_COUNT} SHARDS")
+    LOG.info("=" * 40)
+    LOG.info(f"📊 RUTs procesados: {summary['total']}")
+    LOG.info(f"📊 Exitosos: {summary['total'] - summary['failed']} | Con error: {summary['failed']}")
+    if summary["missing_shards"]:
+        LOG.warning(f"⚠️ Shards sin resultados: {summary['missing_shards']}")
+    LOG.info(f"📄 Resumen guardado en: {path}")
+    return summary
+
+
+class FlagChangeStore:
+    """Feature store en memoria que avisa qué flag cambió (el SDK 9.0 no trae flag_tracker).
+
+    Envuelve al InMemoryFeatureStore del SDK, que se crea recién cuando LaunchDarkly lo usa.
+    """
+
+    def __init__(self):
+        self._store = None
+        self._listeners: List[Callable[[str], None]] = []
+
+    @property
+    def store(self):
+        if self._store is None:
+            from ldclient.feature_store import InMemoryFeatureStore
+            self._store = InMemoryFeatureStore()
+        return self._store
+
+    def __getattr__(self, name):
+        # get, all, initialized y demás lecturas van directo al store del SDK
+        return getattr(self.store, name)
+
+    def add_listener(self, listener: Callable[[str], None]) -> None:
+        self._listeners.append(listener)
+
+    def _notify(self, key: str) -> None:
+        for listener in self._listeners:
+            try:
+                listener(key)
+            except Exception as e:
+                logging.error(f"Error en listener de flags para {key}: {str(e)}")
+
+    def init(self, all_data) -> None:
+        from ldclient.versioned_data_kind import FEATURES
+        if not self.initialized:
+            # Primera carga: no hay estado anterior que comparar y quien conecta ya lee todos los flags
+            self.store.init(all_data)
+            return
+        previous = set(self.all(FEATURES, lambda x: x) or {})
+        self.store.init(all_data)
+        # Una reconexión reemplaza todo el estado: se avisa por cada flag nuevo o eliminado
+        if self._listeners:
+            for key in previous | set(all_data.get(FEATURES, {})):
+                self._notify(key)
+
+    def upsert(self, kind, item) -> None:
+        from ldclient.versioned_data_kind import FEATURES
+        self.store.upsert(kind, item)
+        if kind == FEATURES:
+            self._notify(item['key'])
+
+    def delete(self, kind, key, version) -> None:
+        from ldclient.versioned_data_kind import FEATURES
+        self.store.delete(kind, key, version)
+        if kind == FEATURES:
+            self._notify(key)
+
+
+class FlagProvider:
+    """Flags de LaunchDarkly resueltos de forma perezosa, con snapshot local del último estado válido"""
+
+    def __init__(self, mode: str, snapshot_path: str):
+        self.mode = mode
+        self.snapshot_path = snapshot_path
+        self.store = FlagChangeStore()
+        self._client = None
+        self._lock = threading.Lock()
+
+    def _build_config(self, sdk_key: str) -> Config:
+        from ldclient.config import Config
+        if self.mode == "file":
+            from ldclient.integrations import Files
+            return Config(
+                sdk_key=sdk_key,
+                update_processor_class=Files.new_data_source(paths=[LD_FLAG_FILE]),
+                feature_store=self.store,
+                send_events=False
+            )
+        return Config(
+            sdk_key=sdk_key,
+            stream_uri="https://stream.launchdarkly.com",
+            base_uri="https://app.launchdarkly.com",
+            events_uri="https://events.launchdarkly.com",
+            stream=self.mode != "polling",
+            feature_store=self.store,
+            offline=False
+        )
+
+    def client(self):
+        """Conecta con LaunchDarkly solo la primera vez que se piden flags"""
+        with self._lock:
+            if self._client is not None:
+                return self._client
+
+            # Get LaunchDarkly SDK key from environment
+            ld_sdk_key = os.getenv('LAUNCHDARKLY_SDK_KEY')
+            if not ld_sdk_key:
+                if self.mode != "file":
+                    raise Exception("LAUNCHDARKLY_SDK_KEY no está configurada")
+                ld_sdk_key = "file-data-source"
+
+            # Debug logging for SDK key
+            logging.info(f"=== Iniciando configuración de LaunchDarkly (modo {self.mode}) ===")
+            logging.info(
+                f"SDK Key encontrada (primeros 8 caracteres): {ld_sdk_key[:8]}...")
+            logging.info(f"Longitud de SDK Key: {len(ld_sdk_key)}")
+
+            # Remove quotes and whitespace if present
+            ld_sdk_key = ld_sdk_key.strip().strip("'").strip('"')
+
+            import ldclient
+            with PHASES.span("ld_init"):
+                ldclient.set_config(self._build_config(ld_sdk_key))
+            if not ldclient.get().is_initialized():
+                raise Exception("LaunchDarkly client no se inicializó correctamente")
+            logging.info("✅ LaunchDarkly client inicializado correctamente")
+            self._client = ldclient.get()
+            return self._client
+
+    def is_live(self) -> bool:
+        """Hay un cliente de LaunchDarkly conectado que recibe los cambios de flags"""
+        return self._client is not None
+
+    def read_snapshot(self, max_age_seconds: float) -> Optional[Dict]:
+        try:
+            with open(self.snapshot_path, encoding="utf-8") as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            return None
+        age = time() - snapshot.get("saved_at", 0)
+        if age > max_age_seconds:
+            return None
+        LOG.info(f"📦 Usando snapshot local de flags ({int(age // 60)} minutos de antigüedad)")
+        return snapshot["flags"]
+
+    def write_snapshot(self, flags: Dict) -> None:
+        try:
+            os.makedirs(os.path.dirname(self.snapshot_path), exist_ok=True)
+            tmp_path = f"{self.snapshot_path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"saved_at": time(), "flags": flags}, f)
+            os.replace(tmp_path, self.snapshot_path)
+        except OSError as e:
+            logging.warning(f"No se pudo guardar snapshot de flags: {str(e)}")
+
+    def all_flags(self) -> Dict:
+        """Valores de todos los flags; en modo snapshot no toca la red mientras el snapshot esté vigente.
+
+        Con un cliente ya conectado se lee su estado en memoria, que siempre es más nuevo que el snapshot.
+        """
+        if self.mode == "snapshot" and not self.is_live():
+            flags = self.read_snapshot(LD_SNAPSHOT_MAX_AGE_MINUTES * 60)
+            if flags is not None:
+                return flags
+
+        try:
+            from ldclient import Context
+            context = Context.builder("default").name("default").build()
+            LOG.info("🔗 Conectando con LaunchDarkly...")
+            state = self.client().all_flags_state(context)
+            if not state.valid:
+                raise Exception("Estado de flags de LaunchDarkly no válido")
+        except Exception as e:
+            # Ante una caída de LaunchDarkly se usa el último estado bueno conocido
+            flags = self.read_snapshot(LD_SNAPSHOT_FALLBACK_HOURS * 3600)
+            if flags is None:
+                raise
+            LOG.warning(f"⚠️ LaunchDarkly no disponible ({str(e)}), usando snapshot")
+            logging.warning(f"LaunchDarkly no disponible, usando snapshot: {str(e)}")
+            return flags
+
+        flags = {k: v for k, v in state.to_json_dict().items() if not k.startswith('$')}
+        self.write_snapshot(flags)
+        return flags
+
+    def variation(self, key: str, default=False):
+        from ldclient import Context
+        context = Context.builder("default").name("default").build()
+        return self.client().variation(key, context, default)
+
+    def add_listener(self, listener: Callable[[str], None]) -> None:
+        """Registra una función que recibe la key de cada flag que cambia en LaunchDarkly"""
+        self.store.add_listener(listener)
+
+    def close(self) -> None:
+        if self._client is not None:
+            self._client.close()
+
+
+FLAG_PROVIDER = FlagProvider(LD_MODE, LD_SNAPSHOT_FILE)
 
 
 def get_active_ruts() -> List[str]:
     """Get all valid RUTs from LaunchDarkly flags"""
-    print("🏳️ Obteniendo RUTs activos desde LaunchDarkly...")
+    LOG.info("🏳️ Obteniendo RUTs activos desde LaunchDarkly...")
     active_ruts = []
     try:
-        context = Context.builder("default").name("default").build()
-        print("🔗 Conectando con LaunchDarkly...")
-        all_flags = ldclient.get().all_flags_state(context)
-
-        if all_flags.valid:
-            flags_dict = all_flags.to_json_dict()
-            print(f"📊 Total de flags encontrados: {len(flags_dict)}")
+        with PHASES.span("flag_fetch"):
+            flags_dict = FLAG_PROVIDER.all_flags()
+        if flags_dict:
+            LOG.info(f"📊 Total de flags encontrados: {len(flags_dict)}")
             logging.info(f"Flags encontrados: {list(flags_dict.keys())}")
 
             valid_ruts_count = 0
             for flag_key in flags_dict:
                 if not flag_key.startswith('$') and flag_key != 'CLOCK_IN_ACTIVE':
-                    print(f"🔍 Analizando flag: {flag_key}")
+                    if LOG_VERBOSE:
+                        LOG.debug(f"🔍 Analizando flag: {flag_key}")
                     if is_valid_rut(flag_key) and flags_dict[flag_key]:
-                        active_ruts.append(flag_key.lower())
                         valid_ruts_count += 1
-                        print(
-                            f"✅ RUT válido #{valid_ruts_count}: {flag_key[:4]}****")
-                    else:
-                        print(f"❌ RUT inválido o desactivado: {flag_key}")
-
-            print(f"📋 Total de RUTs válidos encontrados: {len(active_ruts)}")
+                        if not in_shard(flag_key):
+                            if LOG_VERBOSE:
+                                LOG.debug(f"⏭️ RUT válido #{valid_ruts_count}: {flag_key[:4]}**** pertenece a otro shard")
+                            continue
+                        active_ruts.append(flag_key.lower())
+                        set_flag_endpoint(flag_key, flags_dict[flag_key])
+                        if LOG_VERBOSE:
+                            LOG.debug(f"✅ RUT válido #{valid_ruts_count}: {flag_key[:4]}****")
+                    elif LOG_VERBOSE:
+                        LOG.debug(f"❌ RUT inválido o desactivado: {flag_key}")
+
+            LOG.info(f"📋 Total de RUTs válidos encontrados: {valid_ruts_count}")
+            if SHARD_COUNT > 1:
+                LOG.info(f"🧩 Shard {SHARD_INDEX}/{SHARD_COUNT}: {len(active_ruts)} RUTs asignados")
         else:
-            print("❌ Error: Estado de flags de LaunchDarkly no válido")
+            LOG.error("❌ Error: LaunchDarkly no devolvió flags")
 
         return active_ruts
     except Exception as e:
-        print(f"❌ Error obteniendo RUTs: {str(e)}")
+        LOG.error(f"❌ Error obteniendo RUTs: {str(e)}")
         logging.error(f"Error obteniendo RUTs: {str(e)}")
         return []
 
 
+class ActiveRoster:
+    """RUTs activos que se actualizan uno a uno con los eventos de cambio de flags.
+
+    Si al iniciar no hay cliente de LaunchDarkly (modo snapshot o LaunchDarkly caído), se conecta
+    en segundo plano con reintentos y, mientras tanto, los flags se releen en cada ventana.
+    """
+
+    RECONNECT_MIN_SECONDS = 5.0
+    RECONNECT_MAX_SECONDS = 300.0
+
+    def __init__(self, provider: FlagProvider):
+        self.provider = provider
+        self._lock = threading.Lock()
+        self._ruts = set(get_active_ruts())
+        # Los avisos llegan desde el hilo del SDK, a veces con la conexión a medio crear: solo se
+        # encolan, y otro hilo evalúa el flag fuera de ese contexto
+        self._changes: "queue.Queue[str]" = queue.Queue()
+        provider.add_listener(self._changes.put)
+        threading.Thread(target=self._apply_changes, name="ld-roster", daemon=True).start()
+        if not provider.is_live():
+            threading.Thread(target=self._connect, name="ld-connect", daemon=True).start()
+
+    def _connect(self) -> None:
+        delay = self.RECONNECT_MIN_SECONDS
+        while not self.provider.is_live():
+            try:
+                self.provider.client()
+            except Exception as e:
+                logging.warning(f"LaunchDarkly sigue sin conectar, reintento en {delay:.0f}s: {str(e)}")
+                sleep(delay)
+                delay = min(delay * 2, self.RECONNECT_MAX_SECONDS)
+        # Desde aquí los cambios llegan por el listener; se parte del estado completo del cliente
+        self.refresh()
+        LOG.info("🔗 LaunchDarkly conectado: la lista de RUTs se actualiza en vivo")
+
+    def refresh(self) -> None:
+        ruts = set(get_active_ruts())
+        # Una lectura fallida devuelve [] y no debe vaciar la lista mientras no haya cliente
+        if ruts or self.provider.is_live():
+            with self._lock:
+                self._ruts = ruts
+
+    def _apply_changes(self) -> None:
+        while True:
+            flag_key = self._changes.get()
+            try:
+                self._on_flag_change(flag_key)
+            except Exception as e:
+                logging.error(f"Error aplicando cambio de flag {flag_key[:4]}****: {str(e)}")
+
+    def _on_flag_change(self, flag_key: str) -> None:
+        if flag_key == 'CLOCK_IN_ACTIVE' or not is_valid_rut(flag_key) or not in_shard(flag_key):
+            return
+        value = self.provider.variation(flag_key)
+        active = bool(value)
+        if active:
+            set_flag_endpoint(flag_key, value)
+        with self._lock:
+            if active:
+                self._ruts.add(flag_key.lower())
+            else:
+                self._ruts.discard(flag_key.lower())
+        LOG.info(f"🔔 RUT {flag_key[:4]}**** {'activado' if active else 'desactivado'} en LaunchDarkly")
+        logging.info(f"Cambio de flag: RUT {flag_key[:4]}**** activo={active}")
+
+    def active(self) -> List[str]:
+        if not self.provider.is_live():
+            # Sin cliente no llegan eventos de cambio: se releen los flags en cada ventana
+            self.refresh()
+        with self._lock:
+            return sorted(self._ruts)
+
+
+class DelayAllocator:
+    """Reparte inicios únicos al segundo dentro de la ventana, con separación mínima entre marcajes"""
+
+    def __init__(self, start_seconds: int, end_seconds: int, min_spacing: int):
+        self.start = start_seconds
+        self.end = end_seconds
+        self.min_spacing = max(0, min_spacing)
+        # Cada slot mide el doble de la separación: el jitter dentro del slot nunca la rompe
+        self.slot_width = max(1, 2 * self.min_spacing)
+        self.jitter = self.slot_width - max(1, self.min_spacing)
+        self.slot_count = max(1, (end_seconds - start_seconds + 1) // self.slot_width)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self.registry: Dict[str, int] = {}
+            self.coincidences = 0
+            self._used = set()
+            self._layer = 0
+            self._new_layer()
+
+    def _new_layer(self) -> None:
+        # Permutación perezosa de slots (Fisher-Yates disperso): cada sorteo es O(1) y sin repetición
+        self._remaining = self.slot_count
+        self._swaps: Dict[int, int] = {}
+
+    def _draw_slot(self) -> int:
+        if self._remaining == 0:
+            self._layer += 1
+            self._new_layer()
+            if self._layer == 1:
+                LOG.warning(f"⚠️ Más RUTs que slots de {self.slot_width}s en la ventana: la separación mínima ya no está garantizada")
+                logging.warning("Ventana de delays llena, se reduce la separación entre marcajes")
+        last = self._remaining - 1
+        pick = random.randint(0, last)
+        slot = self._swaps.get(pick, pick)
+        self._swaps[pick] = self._swaps.get(last, last)
+        self._swaps.pop(last, None)
+        self._remaining = last
+        return slot
+
+    def allocate(self, rut: str) -> int:
+        """Devuelve el delay en segundos de un RUT; un mismo RUT siempre recibe el mismo delay"""
+        with self._lock:
+            if rut in self.registry:
+                return self.registry[rut]
+
+            slot = self._draw_slot()
+            seconds = self.start + slot * self.slot_width + random.randint(0, self.jitter)
+
+            # Garantizar segundos únicos: se avanza al siguiente segundo libre de la ventana
+            span = self.end - self.start + 1
+            for probe in range(span):
+                candidate = self.start + (seconds - self.start + probe) % span
+                if candidate not in self._used:
+                    seconds = candidate
+                    break
+            else:
+                self.coincidences += 1
+                logging.warning(f"⚠️ Ventana sin segundos libres para RUT {rut[:4]}****, se repite un inicio")
+
+            self._used.add(seconds)
+            self.registry[rut] = seconds
+
+        logging.info(f"Delay aleatorio generado para RUT {rut[:4]}****: {format_delay(seconds)}")
+        return seconds
+
+
+def format_delay(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    return f"{minutes}m {seconds:02d}s"
+
+
+DELAY_ALLOCATOR = DelayAllocator(
+    start_seconds=int(float(os.getenv('DELAY_WINDOW_START_MINUTES', '1')) * 60),
+    end_seconds=int(float(os.getenv('DELAY_WINDOW_MINUTES', '20')) * 60),
+    min_spacing=int(os.getenv('DELAY_MIN_SPACING_SECONDS', '15')),
+)
+
+
+# Hora programada (epoch) y delay final de cada RUT de la ejecución en curso
+SCHEDULE_PLAN: Dict[str, float] = {}
+PLANNED_DELAYS: Dict[str, float] = {}
+
+
 def get_random_delay(rut: str) -> int:
-    """Genera un delay aleatorio entre 1 y 20 minutos y evita coincidencias"""
-    global DELAY_REGISTRY, DELAY_COINCIDENCES
-    
-    # Máximo intentos para evitar un bucle infinito
-    max_attempts = 10
-    attempts = 0
-    
-    while attempts < max_attempts:
-        delay_minutes = random.randint(1, 20)
-        
-        # Si es el primer RUT o no hay coincidencia, aceptamos el delay
-        if len(DELAY_REGISTRY) == 0 or delay_minutes not in DELAY_REGISTRY.values():
+    """Delay aleatorio en segundos dentro de la ventana configurada, sin coincidencias entre RUTs"""
+    return DELAY_ALLOCATOR.allocate(rut)
+
+
+class ServiceTimeHistory:
+    """Historial local (SQLite) de cuánto tarda el marcaje de cada RUT, por acción y motor"""
+
+    MAX_SAMPLES = 20
+
+    def __init__(self, path: str, default_seconds: float):
+        import sqlite3
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.default_seconds = default_seconds
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        with self._db:
+            self._db.execute("""CREATE TABLE IF NOT EXISTS service_times (
+                rut TEXT NOT NULL, action TEXT NOT NULL, engine TEXT NOT NULL,
+                seconds REAL NOT NULL, recorded_at REAL NOT NULL)""")
+            self._db.execute("""CREATE INDEX IF NOT EXISTS service_times_key
+                ON service_times (action, engine, rut, recorded_at)""")
+
+    def record(self, samples: List[Tuple[str, str, float]]) -> None:
+        """Guarda (rut, acción, segundos) y deja solo las últimas MAX_SAMPLES mediciones de cada RUT"""
+        if not samples:
+            return
+        now = time()
+        with self._lock, self._db:
+            self._db.executemany(
+                "INSERT INTO service_times VALUES (?, ?, ?, ?, ?)",
+                [(rut, action, SUBMIT_ENGINE, seconds, now) for rut, action, seconds in samples])
+            for rut, action in {(rut, action) for rut, action, _ in samples}:
+                self._db.execute("""DELETE FROM service_times WHERE rowid IN (
+                    SELECT rowid FROM service_times WHERE rut = ? AND action = ? AND engine = ?
+                    ORDER BY recorded_at DESC LIMIT -1 OFFSET ?)""",
+                                 (rut, action, SUBMIT_ENGINE, self.MAX_SAMPLES))
+
+    def estimates(self, ruts: List[str], action: str) -> Dict[str, float]:
+        """p90 del historial de cada RUT; sin historial, el p90 de todos o el valor por defecto"""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT rut, seconds FROM service_times WHERE action = ? AND engine = ?",
+                (action, SUBMIT_ENGINE)).fetchall()
+        by_rut: Dict[str, List[float]] = {}
+        for rut, seconds in rows:
+            by_rut.setdefault(rut, []).append(seconds)
+        fallback = percentile([seconds for _, seconds in rows], 90) if rows else self.default_seconds
+        return {rut: percentile(by_rut[rut], 90) if rut in by_rut else fallback for rut in ruts}
+
+
+SERVICE_HISTORY = None
+
+
+def get_service_history() -> ServiceTimeHistory:
+    global SERVICE_HISTORY
+    if SERVICE_HISTORY is None:
+        SERVICE_HISTORY = ServiceTimeHistory(SERVICE_HISTORY_FILE, SERVICE_TIME_DEFAULT_SECONDS)
+    return SERVICE_HISTORY
+
+
+def record_service_times(results: List[Dict]) -> None:
+    """Agrega al historial el tiempo de servicio de cada marcaje real exitoso, sin esperas de admisión"""
+    if not PLANNER or DEBUG_MODE:
+        return
+    samples = [(r["rut"], r["action"], r["service_time"]) for r in results
+               if r["status"] == "ok" and r.get("action") and r.get("service_time") is not None]
+    try:
+        get_service_history().record(samples)
+    except Exception as e:
+        logging.warning(f"No se pudo guardar el historial de tiempos de servicio: {str(e)}")
+
+
+def run_deadline(chile_time: datetime, action: str) -> datetime:
+    """Hora límite para que terminen todos los marcajes de esta ejecución"""
+    deadline = chile_time + timedelta(minutes=RUN_DEADLINE_MINUTES)
+    fixed = DEADLINE_ENTRADA if action == "ENTRADA" else DEADLINE_SALIDA
+    if fixed:
+        hour, minute = fixed
+        deadline = min(deadline, chile_time.replace(hour=hour, minute=minute, second=0, microsecond=0))
+    return deadline
+
+
+def simulate_schedule(delays: Dict[str, float], estimates: Dict[str, float], budget: float,
+                      workers: int) -> Tuple[List[str], float]:
+    """Simula el despacho con `workers` sesiones y devuelve (RUTs que terminarían tarde, fin estimado)"""
+    free_at = [0.0] * max(1, workers)
+    late, finish = [], 0.0
+    # Mismo orden que el heap de despacho: por inicio y, a igual inicio, el de menor holgura (EDF)
+    for rut in sorted(delays, key=lambda r: (delays[r], budget - estimates[r], r)):
+        start = max(delays[rut], heapq.heappop(free_at))
+        end = start + estimates[rut]
+        heapq.heappush(free_at, end)
+        finish = max(finish, end)
+        if end > budget:
+            late.append(rut)
+    return late, finish
+
+
+def clamp_tail(delays: Dict[str, float], estimates: Dict[str, float], budget: float,
+               spacing: float) -> Dict[str, float]:
+    """Adelanta a cada RUT hasta su último inicio posible sin juntarlos en el mismo segundo.
+
+    Se recorre desde el final: un RUT adelantado empuja al anterior a `spacing` segundos antes,
+    así la cola de la ventana se comprime conservando el orden aleatorio y la separación.
+    """
+    planned: Dict[str, float] = {}
+    previous: Optional[float] = None
+    for rut in sorted(delays, key=lambda r: (delays[r], r), reverse=True):
+        cap = max(0.0, budget - estimates[rut])
+        if previous is not None:
+            cap = min(cap, previous - spacing)
+        planned[rut] = max(0.0, min(delays[rut], cap))
+        # Solo un RUT movido arrastra al siguiente; los que ya partían antes quedan donde estaban
+        previous = planned[rut] if planned[rut] < delays[rut] else None
+    return planned
+
+
+def plan_schedule(delays: Dict[str, float], estimates: Dict[str, float], budget: float,
+                  workers: int, spacing: float = 0.0) -> Tuple[Dict[str, float], List[str], float]:
+    """Ajusta los delays aleatorios para que todos terminen dentro de `budget` segundos.
+
+    Ningún RUT parte después de su último inicio posible (límite menos su tiempo de servicio).
+    Si la cola igual no cabe, la ventana se comprime hacia el inicio conservando el orden aleatorio.
+    """
+    for step in range(10, -1, -1):
+        scale = step / 10
+        planned = clamp_tail({rut: delay * scale for rut, delay in delays.items()}, estimates, budget, spacing)
+        late, finish = simulate_schedule(planned, estimates, budget, workers)
+        if not late:
             break
-            
-        # Si hay coincidencia, incrementamos el contador e intentamos de nuevo
-        attempts += 1
-        # Solo log a nivel debug para no llenar los logs con intentos
-        logging.debug(f"Coincidencia detectada con delay de {delay_minutes} minutos. Reintentando... ({attempts}/{max_attempts})")        # Si después de varios intentos seguimos con coincidencia, aceptamos pero avisamos
-    if attempts == max_attempts:
-        DELAY_COINCIDENCES += 1
-        logging.warning(f"⚠️ No se pudo evitar coincidencia después de {max_attempts} intentos para RUT {rut[:4]}****")
-        print(f"⚠️ No se pudo evitar coincidencia después de {max_attempts} intentos. Se usará delay de {delay_minutes} minutos.")
-    
-    # Registrar el delay final para este RUT
-    DELAY_REGISTRY[rut] = delay_minutes
-    
-    # Log normal sin alertas extras cuando todo funciona bien
-    logging.info(f"Delay aleatorio generado para RUT {rut[:4]}****: {delay_minutes} minutos")
-    return delay_minutes
+    return planned, late, finish
+
+
+def plan_run(delays: Dict[str, float]) -> Tuple[Dict[str, float], Dict[str, float]]:
+    """Planifica la ejecución con el historial y avisa de entrada si el roster no cabe antes del límite.
 
+    Devuelve los delays finales y el último inicio posible de cada RUT (prioridad EDF).
+    """
+    chile_time = datetime.now(pytz.timezone('America/Santiago'))
+    action = action_for(chile_time)
+    deadline = run_deadline(chile_time, action)
+    budget = max(0.0, (deadline - chile_time).total_seconds())
+    try:
+        estimates = get_service_history().estimates(list(delays), action)
+    except Exception as e:
+        logging.warning(f"Historial de tiempos de servicio no disponible: {str(e)}")
+        estimates = {rut: SERVICE_TIME_DEFAULT_SECONDS for rut in delays}
+    workers = min(len(delays), ADMISSION.limit if SUBMIT_ENGINE != "http" else MAX_BROWSERS)
+
+    planned, late, finish = plan_schedule(delays, estimates, budget, workers, DELAY_ALLOCATOR.min_spacing)
+    moved = sum(1 for rut in delays if planned[rut] < delays[rut])
+    LOG.info(f"📐 Plan: {len(delays)} RUTs con {workers} sesión(es), fin estimado "
+             f"{(chile_time + timedelta(seconds=finish)).strftime('%H:%M:%S')} (límite {deadline.strftime('%H:%M:%S')} CLT)")
+    if moved:
+        LOG.info(f"📐 {moved} delay(s) adelantados para terminar antes del límite")
+    if late:
+        needed = sum(estimates.values()) / max(1, workers)
+        LOG.warning(f"⚠️ El roster no cabe en la ventana: {len(late)} RUT(s) terminarían después de las "
+                    f"{deadline.strftime('%H:%M:%S')} con {workers} sesión(es) "
+                    f"(carga estimada {int(needed)}s para {int(budget)}s disponibles)")
+        logging.warning(f"Plan no cabe antes de {deadline.strftime('%H:%M:%S')}: {len(late)} RUT(s) tarde "
+                        f"con {workers} sesiones")
+    return planned, {rut: budget - estimates[rut] for rut in delays}
+
+
+def build_schedule(ruts: List[str]) -> List[Tuple[float, float, str, str]]:
+    """Calcula de antemano la hora de disparo de cada RUT y la deja en un heap ordenado por vencimiento.
+
+    A igual vencimiento sale primero el RUT con el último inicio posible más temprano (EDF),
+    y a igual holgura quedan juntos los de la misma página de marcaje, que reutilizan la sesión.
+    """
+    now = monotonic()
+    wall_now = time()
+    SCHEDULE_PLAN.clear()
+    PLANNED_DELAYS.clear()
+    delays: Dict[str, float] = {}
+    for rut in ruts:
+        if DEBUG_MODE or not RANDOM_DELAYS:
+            delays[rut] = 0
+            LOG.info(f"🔄 Sin delay para RUT {rut[:4]}**** ({'modo DEBUG' if DEBUG_MODE else 'RANDOM_DELAYS=false'})")
+        else:
+            delays[rut] = get_random_delay(rut)
+            LOG.info(
+                f"⏰ Delay aleatorio para RUT {rut[:4]}****: {format_delay(delays[rut])}")
+            logging.info(
+                f"Programando RUT {rut[:4]}**** con delay de {format_delay(delays[rut])}")
+
+    latest_start = {rut: float("inf") for rut in ruts}
+    if PLANNER and ruts:
+        delays, latest_start = plan_run(delays)
+
+    endpoints = {rut: dial_url_for(rut) for rut in ruts}
+    groups: Dict[str, int] = {}
+    for endpoint in endpoints.values():
+        groups[endpoint] = groups.get(endpoint, 0) + 1
+    if len(groups) > 1:
+        LOG.info(f"🌐 {len(groups)} páginas de marcaje: " +
+                 ", ".join(f"{url.rsplit('/', 1)[-1]} ({count} RUTs)" for url, count in sorted(groups.items())))
+
+    schedule: List[Tuple[float, float, str, str]] = []
+    for rut in ruts:
+        heapq.heappush(schedule, (now + delays[rut], now + latest_start[rut], endpoints[rut], rut))
+        SCHEDULE_PLAN[rut] = wall_now + delays[rut]
+        PLANNED_DELAYS[rut] = delays[rut]
+    return schedule
+
+
+def dispatch_schedule(schedule: List[Tuple[float, float, str, str]], executor: ThreadPoolExecutor) -> List[Tuple[Future, str]]:
+    """Envía cada RUT al pool recién cuando vence su hora, así ningún hilo queda esperando un delay"""
+    futures: List[Tuple[Future, str]] = []
+    total = len(schedule)
+    while schedule:
+        due, *_, rut = heapq.heappop(schedule)
+        remaining = due - monotonic()
+        if remaining > 0:
+            LOG.info(
+                f"⏳ Próximo RUT {rut[:4]}**** en {int(remaining)} segundos...")
+            sleep(remaining)
+        LOG.info(
+            f"🚀 Enviando RUT {len(futures) + 1}/{total} al pool de hilos: {rut[:4]}****")
+        futures.append((executor.submit(process_rut, rut), rut))
+    return futures
+
+
+
+def phase_timings_path() -> str:
+    return os.path.join(logs_dir, f"phases-{RUN_ID}-{current_date}.jsonl")
+
+
+def build_run_report(results: List[Dict], started_at: datetime, finished_at: datetime) -> Dict:
+    """Reporte estructurado de una ejecución: totales, percentiles y el detalle de cada RUT"""
+    outcomes = OUTBOX.outcomes if OUTBOX is not None else {}
+    records = []
+    for result in results:
+        record = result_record(result)
+        record["email"] = outcomes.get(result["rut"], "not_sent")
+        record["delay_seconds"] = PLANNED_DELAYS.get(result["rut"], 0)
+        scheduled = SCHEDULE_PLAN.get(result["rut"])
+        record["scheduled_at"] = None
+        record["start_lag_seconds"] = None
+        if scheduled is not None:
+            record["scheduled_at"] = datetime.fromtimestamp(scheduled, started_at.tzinfo).isoformat()
+            if result.get("started_at"):
+                started = datetime.fromisoformat(result["started_at"]).timestamp()
+                record["start_lag_seconds"] = round(started - scheduled, 3)
+        records.append(record)
+
+    durations = [r["duration"] for r in records if r.get("duration") is not None]
+    lags = [r["start_lag_seconds"] for r in records if r["start_lag_seconds"] is not None]
+    phases: Dict[str, List[float]] = {}
+    for record in records:
+        for phase, seconds in record.get("phases", {}).items():
+            phases.setdefault(phase, []).append(seconds)
+    emails: Dict[str, int] = {}
+    for record in records:
+        emails[record["email"]] = emails.get(record["email"], 0) + 1
+    failed = sum(1 for r in records if r["status"] != "ok")
+
+    return {
+        "run_id": RUN_ID,
+        "shard_index": SHARD_INDEX,
+        "shard_count": SHARD_COUNT,
+        "submit_engine": SUBMIT_ENGINE,
+        "run_engine": RUN_ENGINE,
+        "debug_mode": DEBUG_MODE,
+        "started_at": started_at.isoformat(),
+        "finished_at": finished_at.isoformat(),
+        "duration_seconds": round((finished_at - started_at).total_seconds(), 3),
+        "total": len(records),
+        "ok": len(records) - failed,
+        "failed": failed,
+        "retries": sum(r.get("retries", 0) for r in records),
+        "emails": emails,
+        "delay_coincidences": DELAY_ALLOCATOR.coincidences,
+        "concurrency": ADMISSION.snapshot(),
+        "duration": {"p50": percentile(durations, 50), "p95": percentile(durations, 95),
+                     "max": max(durations, default=0.0)},
+        "start_lag": {"p50": percentile(lags, 50), "p95": percentile(lags, 95),
+                      "max": max(lags, default=0.0)},
+        "phases": {phase: {"p50": percentile(values, 50), "p95": percentile(values, 95)}
+                   for phase, values in sorted(phases.items())},
+        "results": records,
+    }
+
+
+def run_report_path(started_at: datetime) -> str:
+    shard = f"-{SHARD_INDEX}-of-{SHARD_COUNT}" if SHARD_COUNT > 1 else ""
+    return os.path.join(logs_dir, f"run-report-{RUN_ID}-{started_at.strftime('%Y-%m-%d-%H%M')}{shard}.json")
+
+
+def prometheus_metrics(report: Dict) -> str:
+    """Métricas de la última ejecución en formato de texto de Prometheus"""
+    shard = f'shard="{report["shard_index"]}"'
+    lines = []
+
+    def gauge(name: str, help_text: str, samples: List[Tuple[str, float]]) -> None:
+        lines.append(f"# HELP marcaje_{name} {help_text}")
+        lines.append(f"# TYPE marcaje_{name} gauge")
+        for labels, value in samples:
+            lines.append(f"marcaje_{name}{{{','.join(filter(None, [shard, labels]))}}} {value}")
+
+    finished = datetime.fromisoformat(report["finished_at"]).timestamp()
+    gauge("last_run_timestamp_seconds", "Fin de la última ejecución (epoch).", [("", round(finished, 3))])
+    gauge("last_run_duration_seconds", "Duración total de la última ejecución.", [("", report["duration_seconds"])])
+    gauge("last_run_ruts", "RUTs procesados en la última ejecución por estado.",
+          [('status="ok"', report["ok"]), ('status="error"', report["failed"])])
+    gauge("last_run_retries", "Reintentos de marcaje en la última ejecución.", [("", report["retries"])])
+    gauge("last_run_browser_concurrency", "Sesiones de navegador simultáneas: límite al final y máximo alcanzado.",
+          [('kind="limit"', report["concurrency"]["limit"]), ('kind="peak"', report["concurrency"]["peak"])])
+    gauge("last_run_emails", "Correos de resultado por desenlace.",
+          [(f'outcome="{outcome}"', count) for outcome, count in sorted(report["emails"].items())])
+    gauge("last_run_mark_seconds", "Duración del marcaje por RUT.",
+          [('quantile="0.5"', report["duration"]["p50"]), ('quantile="0.95"', report["duration"]["p95"]),
+           ('quantile="1"', report["duration"]["max"])])
+    gauge("last_run_start_lag_seconds", "Atraso del inicio real respecto de la hora programada.",
+          [('quantile="0.5"', report["start_lag"]["p50"]), ('quantile="0.95"', report["start_lag"]["p95"]),
+           ('quantile="1"', report["start_lag"]["max"])])
+    gauge("last_run_phase_seconds", "Duración por fase del marcaje.",
+          [(f'phase="{phase}",quantile="{q}"', stats[key])
+           for phase, stats in report["phases"].items() for q, key in (("0.5", "p50"), ("0.95", "p95"))])
+    return "\n".join(lines) + "\n"
+
+
+def write_run_report(results: List[Dict], started_at: datetime) -> Dict:
+    """Guarda el reporte JSON en logs/ y, si está configurado, el textfile de Prometheus"""
+    report = build_run_report(results, started_at, datetime.now(started_at.tzinfo))
+    path = run_report_path(started_at)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    LOG.info(f"📄 Reporte de ejecución guardado en: {path}")
+
+    if METRICS_TEXTFILE:
+        # Escritura atómica: node_exporter nunca debe leer un archivo a medias
+        tmp_path = f"{METRICS_TEXTFILE}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(prometheus_metrics(report))
+        os.replace(tmp_path, METRICS_TEXTFILE)
+        LOG.info(f"📈 Métricas exportadas en: {METRICS_TEXTFILE}")
+    return report
+
+
+def announce_run(ruts: List[str]) -> None:
+    LOG.info("=" * 40)
+    LOG.info(f"👥 INICIANDO PROCESAMIENTO DE {len(ruts)} RUTs")
+    LOG.info("=" * 40)
+
+
+def warm_browsers() -> None:
+    """Lanza una sesión de Chrome antes del primer RUT cuando el motor la va a necesitar"""
+    if DEBUG_MODE or SUBMIT_ENGINE == "http":
+        return
+    LOG.info("🌐 Preparando sesión de navegador...")
+    try:
+        get_browser_pool().warm(1)
+    except Exception as e:
+        LOG.warning(f"⚠️ No se pudo precalentar el navegador: {str(e)}")
+
+
+def shutdown_pools() -> None:
+    if BROWSER_POOL is not None:
+        BROWSER_POOL.shutdown()
+        LOG.info("🌐 Navegadores cerrados")
+    if HTTP_POOL is not None:
+        HTTP_POOL.shutdown()
+    if OUTBOX is not None:
+        OUTBOX.close()
+    FLAG_PROVIDER.close()
+
+
+def run_with_threads(ruts: List[str]) -> List[Dict]:
+    """Procesa los RUTs en un pool de hilos, despachando cada uno cuando vence su delay"""
+    ruts = skip_completed(ruts)
+    announce_run(ruts)
+    if not ruts:
+        return []
+
+    # Los delays se calculan de antemano; el pool solo limita navegadores concurrentes
+    schedule = build_schedule(ruts)
+    warm_browsers()
+
+    results = []
+    with ThreadPoolExecutor(max_workers=min(len(ruts), MAX_BROWSERS)) as executor:
+        LOG.info(f"🧵 Usando {min(len(ruts), MAX_BROWSERS)} hilos paralelos "
+                 f"(límite inicial de navegadores: {ADMISSION.limit})")
+        futures = dispatch_schedule(schedule, executor)
+
+        LOG.info("⏳ Esperando completación de todos los hilos...")
+        completed = 0
+        for future, rut in futures:
+            try:
+                result = future.result()
+                results.append(result)
+                completed += 1
+                if result["status"] == "ok":
+                    LOG.info(
+                        f"✅ Completado {completed}/{len(futures)} - RUT: {rut[:4]}****")
+                else:
+                    LOG.error(
+                        f"❌ Error {completed}/{len(futures)} - RUT: {rut[:4]}****: {result['error']}")
+            except Exception as e:
+                completed += 1
+                LOG.error(
+                    f"❌ Error {completed}/{len(futures)} - RUT: {rut[:4]}****: {str(e)}")
+    return results
+
+
+async def run_with_asyncio(ruts: List[str]) -> List[Dict]:
+    """Procesa los RUTs como corrutinas: los delays no ocupan hilos y un semáforo limita las sesiones"""
+    import asyncio
+    ruts = await asyncio.to_thread(skip_completed, ruts)
+    announce_run(ruts)
+    if not ruts:
+        return []
+
+    loop = asyncio.get_running_loop()
+    # Solo el marcaje bloquea, así que bastan unos pocos hilos para cualquier cantidad de RUTs
+    loop.set_default_executor(ThreadPoolExecutor(
+        max_workers=MAX_BROWSERS + 2, thread_name_prefix="marcaje"))
+    sessions = asyncio.Semaphore(MAX_BROWSERS)
+    LOG.info(f"🧵 Usando asyncio con hasta {MAX_BROWSERS} sesiones concurrentes")
+
+    schedule = build_schedule(ruts)
+    await asyncio.to_thread(warm_browsers)
+
+    async def run_one(due: float, rut: str) -> Dict:
+        await asyncio.sleep(max(0.0, due - monotonic()))
+        async with sessions:
+            result = await asyncio.to_thread(mark_rut, rut)
+        notify_result(result)
+        return result
+
+    tasks = [asyncio.create_task(run_one(due, rut)) for due, *_, rut in sorted(schedule)]
+    results = []
+    # Se informa cada RUT apenas termina, no en el orden en que se programó
+    for completed, next_done in enumerate(asyncio.as_completed(tasks), 1):
+        result = await next_done
+        results.append(result)
+        if result["status"] == "ok":
+            LOG.info(
+                f"✅ Completado {completed}/{len(tasks)} - RUT: {result['rut'][:4]}****")
+        else:
+            LOG.error(
+                f"❌ Error {completed}/{len(tasks)} - RUT: {result['rut'][:4]}****: {result['error']}")
+    return results
+
+
+async def main_async() -> Tuple[List[str], List[Dict]]:
+    """Feriado, flags, delays, marcaje y notificación corriendo sobre un solo event loop"""
+    import asyncio
+    if await asyncio.to_thread(is_holiday):
+        LOG.info("🎄 Terminando ejecución - hoy es feriado")
+        exit()
+
+    LOG.info("🔍 Obteniendo lista de RUTs para procesar...")
+    ruts = await asyncio.to_thread(get_active_ruts)
+    if not ruts:
+        return ruts, []
+    return ruts, await run_with_asyncio(ruts)
+
+
+def parse_windows(value: str) -> List[Tuple[int, int]]:
+    """Convierte "08:10,17:30" en [(8, 10), (17, 30)]"""
+    windows = []
+    for part in value.split(","):
+        hour, minute = part.strip().split(":")
+        windows.append((int(hour), int(minute)))
+    return sorted(windows)
+
+
+DAEMON_WINDOWS = parse_windows(os.getenv('DAEMON_WINDOWS', '08:10,17:30'))
+
+def next_window(now: datetime) -> datetime:
+    """Próxima ventana de marcaje de lunes a viernes, en hora de Chile"""
+    chile_tz = pytz.timezone('America/Santiago')
+    for offset in range(8):
+        day = (now + timedelta(days=offset)).date()
+        if day.weekday() >= 5:
+            continue
+        for hour, minute in DAEMON_WINDOWS:
+            fire_at = chile_tz.localize(datetime(day.year, day.month, day.day, hour, minute))
+            if fire_at > now:
+                return fire_at
+    raise Exception("No hay ventanas de marcaje configuradas")
+
+
+def run_daemon() -> None:
+    """Servicio residente: mantiene LaunchDarkly, navegadores y SMTP calientes y dispara cada ventana"""
+    chile_tz = pytz.timezone('America/Santiago')
+    LOG.info(f"🛰️ Modo daemon activo - ventanas: {', '.join(f'{h:02d}:{m:02d}' for h, m in DAEMON_WINDOWS)} (CLT)")
+
+    roster = ActiveRoster(FLAG_PROVIDER)
+    LOG.info(f"👥 RUTs activos al iniciar: {len(roster.active())}")
+
+    while True:
+        fire_at = next_window(datetime.now(chile_tz))
+        LOG.info(f"⏭️ Próxima ventana de marcaje: {fire_at.strftime('%Y-%m-%d %H:%M')} (CLT)")
+        sleep(max(0.0, (fire_at - datetime.now(chile_tz)).total_seconds()))
+
+        if is_holiday():
+            LOG.info("🎄 Ventana omitida - hoy es feriado")
+            continue
+
+        ruts = roster.active()
+        if not ruts:
+            LOG.error("❌ No hay RUTs activos para esta ventana")
+            continue
+
+        DELAY_ALLOCATOR.reset()
+        BREAKER.reset()
+        ADMISSION.reset_peak()
+        if RUN_ENGINE == "asyncio":
+            import asyncio
+            results = asyncio.run(run_with_asyncio(ruts))
+        else:
+            results = run_with_threads(ruts)
+        if BROWSER_POOL is not None:
+            BROWSER_POOL.blank_idle()
+        get_outbox().flush_digest()
+        # El reporte lee si salió el correo de cada RUT: primero se espera al outbox
+        get_outbox().drain()
+        PHASES.flush(phase_timings_path())
+        write_run_report(results, fire_at)
+        record_service_times(results)
+
+        failed = sum(1 for r in results if r["status"] != "ok")
+        LOG.info(f"🏁 Ventana completada: {len(results) - failed} exitosos, {failed} con error")
 
-# Variables para monitoreo de delays
-DELAY_REGISTRY: Dict[str, int] = {}  # Registro de delays por RUT
-DELAY_COINCIDENCES = 0  # Contador de coincidencias de delays
 
 # Verificar si debemos ejecutar el script
 if __name__ == "__main__":
-    print("=" * 60)
-    print("🚀 INICIANDO SCRIPT DE MARCAJE AUTOMÁTICO")
-    print("=" * 60)
+    LOG.info("=" * 60)
+    LOG.info("🚀 INICIANDO SCRIPT DE MARCAJE AUTOMÁTICO")
+    LOG.info("=" * 60)
     
     # Get Chile time right at the start
     chile_tz = pytz.timezone('America/Santiago')
     chile_time = datetime.now(chile_tz)
-    print(f"⏰ HORA DE INICIO: {chile_time.strftime('%Y-%m-%d %H:%M:%S')} (CLT)")
+    LOG.info(f"⏰ HORA DE INICIO: {chile_time.strftime('%Y-%m-%d %H:%M:%S')} (CLT)")
     logging.info(f"Script iniciado a las: {chile_time.strftime('%Y-%m-%d %H:%M:%S')} (CLT)")
     
-    print("🔍 Verificando configuración inicial...")
+    if SHARD_MERGE:
+        merge_shard_results()
+        exit()
+
+    LOG.info("🔍 Verificando configuración inicial...")
     if not CLOCK_IN_ACTIVE:
-        print("⏹️ Script desactivado por variable CLOCK_IN_ACTIVE")
+        LOG.info("⏹️ Script desactivado por variable CLOCK_IN_ACTIVE")
         logging.info(
             "Script desactivado por variable de entorno CLOCK_IN_ACTIVE")
         exit()
 
-    print("✅ Script activo, continuando...")
+    LOG.info("✅ Script activo, continuando...")
 
-    if is_holiday():
-        print("🎄 Terminando ejecución - hoy es feriado")
+    if DAEMON_MODE:
+        try:
+            run_daemon()
+        except KeyboardInterrupt:
+            LOG.info("⏹️ Daemon detenido")
+        finally:
+            shutdown_pools()
+            PHASES.flush(phase_timings_path())
         exit()
 
-    # ELIMINAR EL DELAY GLOBAL - ahora cada RUT tendrá su propio delay
-    print("🔍 Obteniendo lista de RUTs para procesar...")
-    ruts = get_active_ruts()
+    if RUN_ENGINE == "asyncio":
+        import asyncio
+        ruts, results = asyncio.run(main_async())
+    else:
+        if is_holiday():
+            LOG.info("🎄 Terminando ejecución - hoy es feriado")
+            exit()
+
+        # ELIMINAR EL DELAY GLOBAL - ahora cada RUT tendrá su propio delay
+        LOG.info("🔍 Obteniendo lista de RUTs para procesar...")
+        ruts = get_active_ruts()
+        results = run_with_threads(ruts) if ruts else []
+
+    shutdown_pools()
+    PHASES.flush(phase_timings_path())
+    write_run_report(results, chile_time)
+    record_service_times(results)
+
+    if SHARD_COUNT > 1:
+        write_shard_results(results, chile_time)
 
     if not ruts:
-        print("❌ No se encontraron RUTs válidos para procesar")
-        print("🏁 Finalizando script")
+        LOG.error("❌ No se encontraron RUTs válidos para procesar")
+        LOG.info("🏁 Finalizando script")
     else:
-        print("=" * 40)
-        print(f"👥 INICIANDO PROCESAMIENTO DE {len(ruts)} RUTs")
-        print("=" * 40)
-
-        # USAR SOLO UNA OPCIÓN: HILOS (recomendado para múltiples RUTs con delays individuales)
-        with ThreadPoolExecutor(max_workers=min(len(ruts), 5)) as executor:
-            print(f"🧵 Usando {min(len(ruts), 5)} hilos paralelos")
-            futures = []
-
-            for i, rut in enumerate(ruts):
-                print(
-                    f"🚀 Enviando RUT {i+1}/{len(ruts)} al pool de hilos: {rut[:4]}****")
-                future = executor.submit(process_rut, rut)
-                futures.append((future, rut))
-
-            print("⏳ Esperando completación de todos los hilos...")
-            completed = 0
-            for future, rut in futures:
-                try:
-                    future.result()
-                    completed += 1
-                    print(
-                        f"✅ Completado {completed}/{len(futures)} - RUT: {rut[:4]}****")
-                except Exception as e:
-                    completed += 1
-                    print(
-                        f"❌ Error {completed}/{len(futures)} - RUT: {rut[:4]}****: {str(e)}")
-
         # Calculate and show end time and duration
         end_time = datetime.now(chile_tz)
         total_duration = (end_time - chile_time).total_seconds()
         total_minutes, total_seconds = divmod(total_duration, 60)
+        failed = sum(1 for r in results if r["status"] != "ok")
         
-        print("=" * 40)
-        print("🎉 PROCESAMIENTO COMPLETADO")
-        print("=" * 40)
-        print(f"📊 RUTs procesados: {len(ruts)}")
+        LOG.info("=" * 40)
+        LOG.info("🎉 PROCESAMIENTO COMPLETADO")
+        LOG.info("=" * 40)
+        LOG.info(f"📊 RUTs procesados: {len(ruts)}")
+        LOG.info(f"📊 Exitosos: {len(results) - failed} | Con error: {failed}")
+        concurrency = ADMISSION.snapshot()
+        LOG.info(f"🧵 Navegadores simultáneos: límite actual {concurrency['limit']} | "
+                 f"máximo alcanzado {concurrency['peak']} (techo {concurrency['ceiling']})")
         
         # Mostrar resumen de delays
-        print("📊 RESUMEN DE DELAYS:")
-        for r, d in DELAY_REGISTRY.items():
-            print(f"  • RUT {r[:4]}****: {d} minutos")
+        LOG.info("📊 RESUMEN DE DELAYS:")
+        for r, d in PLANNED_DELAYS.items():
+            LOG.info(f"  • RUT {r[:4]}****: {format_delay(d)}")
         
-        if DELAY_COINCIDENCES > 0:
-            print(f"⚠️ ATENCIÓN: Se detectaron {DELAY_COINCIDENCES} coincidencia(s) de delays que no pudieron evitarse")
-            logging.warning(f"Se detectaron {DELAY_COINCIDENCES} coincidencia(s) de delays que no pudieron evitarse")
+        if DELAY_ALLOCATOR.coincidences > 0:
+            LOG.warning(f"⚠️ ATENCIÓN: Se detectaron {DELAY_ALLOCATOR.coincidences} coincidencia(s) de delays que no pudieron evitarse")
+            logging.warning(f"Se detectaron {DELAY_ALLOCATOR.coincidences} coincidencia(s) de delays que no pudieron evitarse")
         
-        print(f"⏰ Hora de inicio: {chile_time.strftime('%H:%M:%S')} (CLT)")
-        print(f"⏰ Hora de finalización: {end_time.strftime('%H:%M:%S')} (CLT)")
-        print(f"⏱️ Duración total: {int(total_minutes)} minutos y {int(total_seconds)} segundos")
-        print("🏁 Script finalizado exitosamente")
+        LOG.info(f"⏰ Hora de inicio: {chile_time.strftime('%H:%M:%S')} (CLT)")
+        LOG.info(f"⏰ Hora de finalización: {end_time.strftime('%H:%M:%S')} (CLT)")
+        LOG.info(f"⏱️ Duración total: {int(total_minutes)} minutos y {int(total_seconds)} segundos")
+        LOG.info("🏁 Script finalizado exitosamente")
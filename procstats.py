@@ -0,0 +1,35 @@
+"""Mediciones compartidas por main.py y benchmark.py: RSS de un árbol de procesos y percentiles."""
+import os
+from typing import Dict, List
+
+
+def tree_rss_kb(pid: int) -> int:
+    """RSS total (kB) de un proceso y todos sus descendientes, leído desde /proc"""
+    children: Dict[int, List[int]] = {}
+    rss: Dict[int, int] = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/status") as f:
+                fields = dict(line.split(":", 1) for line in f if ":" in line)
+        except OSError:
+            continue
+        children.setdefault(int(fields["PPid"]), []).append(int(entry))
+        rss[int(entry)] = int(fields.get("VmRSS", "0 kB").split()[0])
+
+    total, pending = 0, [pid]
+    while pending:
+        current = pending.pop()
+        total += rss.get(current, 0)
+        pending.extend(children.get(current, []))
+    return total
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """Percentil por rango más cercano; 0 si no hay valores"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]